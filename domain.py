@@ -76,11 +76,20 @@ class Domain:
         """
         return None
 
+    def execute_batch(self, semantics_list):
+        """
+        Executes a list of semantic representations, such as those of all the
+        parses of an input, and returns the list of their denotations.  Domains
+        whose executors can share work between them may override this.
+        """
+        return [self.execute(semantics) for semantics in semantics_list]
+
     def model(self):
         return Model(grammar=self.grammar(),
                      feature_fn=self.features,
                      weights=self.weights(),
-                     executor=self.execute)
+                     executor=self.execute,
+                     batch_executor=self.execute_batch)
 
     def metrics(self):
         """Returns a list of Metrics which are appropriate for the domain."""
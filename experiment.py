@@ -9,10 +9,11 @@ __email__ = "See the author's website"
 from collections import defaultdict
 import random
 
-from metrics import SemanticsAccuracyMetric, NumParsesMetric, standard_metrics
+from annotator import Annotator
+from metrics import CorrectnessCache, SemanticsAccuracyMetric, NumParsesMetric, standard_metrics
 from example import Example
-from learning import latent_sgd
-from parsing import is_cat, parse_to_pretty_string, print_grammar
+from learning import latent_sgd, parse_candidates, rescore_candidates
+from parsing import is_cat, is_lexical, is_optional, parse_to_pretty_string, print_grammar, semantics_key
 from scoring import Model, rule_features
 
 # TODO: comment
@@ -176,6 +177,7 @@ def evaluate_dev_examples_for_domain(domain):
 def train_test(model=None,
                train_examples=[],
                test_examples=[],
+               dev_examples=[],
                metrics=standard_metrics(),
                training_metric=SemanticsAccuracyMetric(),
                seed=None,
@@ -198,7 +200,11 @@ def train_test(model=None,
                    print_examples=print_examples)
 
     # Train
-    model = latent_sgd(model, train_examples, training_metric=training_metric, seed=seed)
+    model = latent_sgd(model,
+                       train_examples,
+                       training_metric=training_metric,
+                       seed=seed,
+                       dev_examples=dev_examples)
 
     # 'After' test
     evaluate_model(model=model,
@@ -212,17 +218,197 @@ def train_test(model=None,
                    metrics=metrics,
                    print_examples=print_examples)
 
-def train_test_for_domain(domain, seed=None, print_examples=False):
+def train_test_for_domain(domain, seed=None, print_examples=False, early_stopping=False):
     print('#' * 80)
     print('Train/test experiment for domain: %s\n' % domain.__class__.__name__)
     train_test(model=domain.model(),
                train_examples=domain.train_examples(),
                test_examples=domain.test_examples(),
+               dev_examples=domain.dev_examples() if early_stopping else [],
                metrics=domain.metrics(),
                training_metric=domain.training_metric(),
                seed=seed,
                print_examples=print_examples)
 
+def evaluate_candidates(weights=None,
+                        examples=[],
+                        candidates_cache={},
+                        metrics=standard_metrics()):
+    """
+    Like evaluate_model(), but rather than parsing the examples, rescores their
+    cached Candidates (see learning.parse_candidates()) under the given
+    weights.  Returns a map from metric names to average values.
+    """
+    metric_values = defaultdict(float)
+    for example in examples:
+        candidates = rescore_candidates(candidates_cache[example], weights)
+        parses = [candidate.parse for candidate in candidates]
+        for metric in metrics:
+            metric_values[metric.name()] += metric.evaluate(example, parses)
+    return dict((name, value / len(examples)) for name, value in metric_values.items())
+
+# State shared with the worker processes of sweep_for_domain() and
+# cross_validate_for_domain().  As in learning.parallel_latent_sgd(), it is
+# set before the workers are forked, so that they inherit it.
+_worker_state = {}
+
+def _share_with_workers(domain, examples, seed):
+    """
+    Parses and featurizes the given examples, and stores what workers need
+    to train and evaluate models for the given domain in _worker_state.
+    """
+    model = domain.model()
+    training_metric = domain.training_metric()
+    candidates_cache = {}
+    correctness_cache = CorrectnessCache()
+    for example in examples:
+        candidates_cache[example] = parse_candidates(
+            model, example, training_metric, correctness_cache)
+    _worker_state.update({
+        'model': model,
+        'training_metric': training_metric,
+        'metrics': domain.metrics(),
+        'candidates_cache': candidates_cache,
+        'seed': seed,
+    })
+
+def _map_in_workers(fn, args, processes=None):
+    """
+    Returns [fn(arg) for arg in args], computed in a pool of forked worker
+    processes, or in this process if processes is 1.
+    """
+    import multiprocessing
+    if processes == 1:
+        return [fn(arg) for arg in args]
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        return pool.map(fn, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def _train_and_evaluate(train_examples, eval_examples_by_label, config):
+    """
+    Trains a model with latent_sgd() on the given examples, using the state in
+    _worker_state and the given config of keyword arguments.  Returns the
+    values of the metrics on each of the given sets of examples, keyed by
+    (label, metric name).
+    """
+    from io import StringIO
+    from contextlib import redirect_stdout
+    state = _worker_state
+    # Keep the many workers from interleaving their training logs.
+    with redirect_stdout(StringIO()):
+        model = latent_sgd(state['model'],
+                           list(train_examples),
+                           state['training_metric'],
+                           seed=state['seed'],
+                           candidates_cache=state['candidates_cache'],
+                           **config)
+    values = {}
+    for label, examples in eval_examples_by_label:
+        metric_values = evaluate_candidates(weights=model.weights,
+                                            examples=examples,
+                                            candidates_cache=state['candidates_cache'],
+                                            metrics=state['metrics'])
+        for name, value in metric_values.items():
+            values[(label, name)] = value
+    return values
+
+def sweep_for_domain(domain,
+                     etas=[0.1],
+                     Ts=[10],
+                     l2_penalties=[0.0],
+                     seed=None,
+                     processes=None):
+    """
+    Runs latent_sgd() with every combination of the given values of eta, T,
+    and l2_penalty, evaluates each resulting model on the train and test
+    examples, and prints a table of the results.  The examples are parsed and
+    featurized only once, before a pool of worker processes is forked to run
+    the configurations, and all the workers share the cached candidates.
+    Returns a list of (config, metric values) pairs, where the metric values
+    are keyed by ('train' or 'test', metric name).
+    """
+    from itertools import product
+    print('#' * 80)
+    print('Hyperparameter sweep for domain: %s\n' % domain.__class__.__name__)
+    train_examples = domain.train_examples()
+    test_examples = domain.test_examples()
+    configs = [{'eta': eta, 'T': T, 'l2_penalty': l2_penalty}
+               for eta, T, l2_penalty in product(etas, Ts, l2_penalties)]
+    _share_with_workers(domain, train_examples + test_examples, seed)
+    _worker_state['train_examples'] = train_examples
+    _worker_state['test_examples'] = test_examples
+    print('Running %d configurations' % len(configs))
+    try:
+        results = _map_in_workers(_run_sweep_config, configs, processes)
+    finally:
+        _worker_state.clear()
+    names = [metric.name() for metric in domain.metrics()]
+    print()
+    print('%-8s %-5s %-10s %s' % ('eta', 'T', 'l2_penalty', '   '.join(names)))
+    for config, values in zip(configs, results):
+        cells = ['%*s' % (len(name), '%.3f / %.3f' % (values[('train', name)], values[('test', name)]))
+                 for name in names]
+        print('%-8g %-5d %-10g %s' % (config['eta'], config['T'], config['l2_penalty'], '   '.join(cells)))
+    print('(train / test)')
+    print()
+    return list(zip(configs, results))
+
+def _run_sweep_config(config):
+    """Worker function for sweep_for_domain()."""
+    train_examples = _worker_state['train_examples']
+    test_examples = _worker_state['test_examples']
+    return _train_and_evaluate(train_examples,
+                               [('train', train_examples), ('test', test_examples)],
+                               config)
+
+def cross_validate_for_domain(domain, k=5, seed=None, processes=None, **config):
+    """
+    Runs k-fold cross-validation of latent_sgd() over the training examples of
+    the given domain.  The examples are split into k folds, and for each
+    fold, a model is trained on the other folds and evaluated on it, each fold
+    in its own worker process.  As in sweep_for_domain(), the examples are
+    parsed only once.  Any remaining keyword arguments are passed to
+    latent_sgd().  Prints and returns a map from metric names to the mean
+    and variance of their values across the folds.  There must be at least
+    two folds, so that each fold has examples to train on, and at most as
+    many folds as examples, so that each has examples to evaluate on.
+    """
+    examples = list(domain.train_examples())
+    if not 2 <= k <= len(examples):
+        raise ValueError('Need between 2 and %d folds for %d examples, not %d' % (
+            len(examples), len(examples), k))
+    print('#' * 80)
+    print('%d-fold cross-validation for domain: %s\n' % (k, domain.__class__.__name__))
+    random.Random(seed).shuffle(examples)
+    folds = [examples[i::k] for i in range(k)]
+    _share_with_workers(domain, examples, seed)
+    _worker_state['folds'] = folds
+    _worker_state['config'] = config
+    try:
+        results = _map_in_workers(_run_fold, list(range(k)), processes)
+    finally:
+        _worker_state.clear()
+    print('Over %d folds of %d examples:' % (k, len(examples)))
+    print()
+    summary = {}
+    for metric in domain.metrics():
+        values = [values[('test', metric.name())] for values in results]
+        mean = sum(values) / k
+        variance = sum((value - mean)**2 for value in values) / (k - 1)
+        summary[metric.name()] = (mean, variance)
+        print('%-34s %.3f (std. dev. %.3f)' % (metric.name(), mean, variance**0.5))
+    print()
+    return summary
+
+def _run_fold(i):
+    """Worker function for cross_validate_for_domain()."""
+    folds = _worker_state['folds']
+    train_examples = [example for j, fold in enumerate(folds) if j != i for example in fold]
+    return _train_and_evaluate(train_examples, [('test', folds[i])], _worker_state['config'])
+
 def cartesian_product_of_lexical_rules(rules, restrict_by_lhs=True):
     """
     Expands the given collection of rules by iterating through all possible
@@ -247,19 +433,144 @@ def cartesian_product_of_lexical_rules(rules, restrict_by_lhs=True):
             expanded_rules.append(Rule(rule.lhs, rule.rhs, sem))
     return expanded_rules
 
-def learn_lexical_semantics(domain, seed=None):
+def semantic_atoms(value):
+    """
+    Returns the set of atomic values (such as entities, numbers, and operator
+    names) which occur in the given semantics or denotation.  The values in a
+    dict are atoms both by themselves and paired with their keys.
+    """
+    if isinstance(value, dict):
+        atoms = set()
+        for key, v in value.items():
+            for atom in semantic_atoms(v):
+                atoms.add(atom)
+                atoms.add((key, atom))
+        return atoms
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return set(atom for v in value for atom in semantic_atoms(v))
+    return set([semantics_key(value)])
+
+def optional_variants(rhs):
+    """
+    Returns the RHSs into which parsing.add_rule_containing_optional() would
+    expand the given RHS.
+    """
+    first = next((idx for idx, elt in enumerate(rhs) if is_optional(elt)), -1)
+    if first < 0:
+        return [rhs]
+    prefix, suffix = rhs[:first], rhs[(first + 1):]
+    return (optional_variants(prefix + (rhs[first][1:],) + suffix) +
+            optional_variants(prefix + suffix))
+
+class LazyLexiconAnnotator(Annotator):
+    """
+    An alternative to cartesian_product_of_lexical_rules() which avoids
+    building a grammar quadratic in the size of the lexicon.  When the parser
+    asks it to annotate the RHS of one of the given lexical rules, it pairs the
+    phrase with the semantics of all the lexical rules with the same LHS (or of
+    all lexical rules, if restrict_by_lhs is false), just as the Cartesian
+    product would.  But the pairs are generated only for phrases which are
+    actually parsed, and are pruned using the given training examples: a
+    semantics co-occurs with an example if all its atoms (see semantic_atoms())
+    occur in the semantics or denotation of the example.  The semantics for
+    each phrase are ranked by the Dice coefficient of their co-occurrence with
+    it, those which co-occur with it in fewer than min_count examples are
+    dropped, and at most max_per_phrase are kept.  The annotations for each
+    phrase are computed only once.
+
+    Annotations become Rules with the phrase as RHS, so they get the same
+    rule features as the rules in the Cartesian product.
+    """
+    def __init__(self, rules, examples, max_per_phrase=10, min_count=1, restrict_by_lhs=True):
+        self.max_per_phrase = max_per_phrase
+        self.min_count = min_count
+        # Map from phrases to (LHS, partition) pairs, and from partitions to
+        # distinct semantics, both in rule order.
+        self.lhs_by_phrase = defaultdict(list)
+        self.sems_by_partition = defaultdict(list)
+        sem_keys = set()
+        for rule in rules:
+            if not is_lexical(rule):
+                continue
+            partition = rule.lhs if restrict_by_lhs else 'dummy'
+            for phrase in optional_variants(rule.rhs):
+                if (rule.lhs, partition) not in self.lhs_by_phrase[phrase]:
+                    self.lhs_by_phrase[phrase].append((rule.lhs, partition))
+            if (partition, semantics_key(rule.sem)) not in sem_keys:
+                sem_keys.add((partition, semantics_key(rule.sem)))
+                self.sems_by_partition[partition].append(rule.sem)
+        # Atoms of each example, and the examples in which each phrase occurs.
+        self.example_atoms = [semantic_atoms(example.semantics) | semantic_atoms(example.denotation)
+                              for example in examples]
+        self.examples_by_phrase = defaultdict(set)
+        max_length = max([len(phrase) for phrase in self.lhs_by_phrase] or [0])
+        for index, example in enumerate(examples):
+            tokens = tuple(example.input.split())
+            for i in range(len(tokens)):
+                for j in range(i + 1, min(i + max_length, len(tokens)) + 1):
+                    if tokens[i:j] in self.lhs_by_phrase:
+                        self.examples_by_phrase[tokens[i:j]].add(index)
+        self.sem_counts = {}
+        self.annotations = {}
+
+    def annotate(self, tokens):
+        phrase = tuple(tokens)
+        if phrase not in self.lhs_by_phrase:
+            return []
+        if phrase not in self.annotations:
+            self.annotations[phrase] = [(lhs, sem)
+                                        for lhs, partition in self.lhs_by_phrase[phrase]
+                                        for sem in self.ranked_semantics(phrase, partition)]
+        return self.annotations[phrase]
+
+    def ranked_semantics(self, phrase, partition):
+        phrase_examples = self.examples_by_phrase[phrase]
+        scored = []
+        for sem in self.sems_by_partition[partition]:
+            atoms = semantic_atoms(sem)
+            count = sum(1 for index in phrase_examples if atoms <= self.example_atoms[index])
+            if count < self.min_count:
+                continue
+            key = semantics_key(sem)
+            if key not in self.sem_counts:
+                self.sem_counts[key] = sum(1 for example_atoms in self.example_atoms
+                                           if atoms <= example_atoms)
+            dice = 2.0 * count / (len(phrase_examples) + self.sem_counts[key]) if count else 0.0
+            scored.append((dice, sem))
+        # Sorting is stable, so ties stay in rule order.
+        scored = sorted(scored, key=lambda pair: pair[0], reverse=True)
+        return [sem for dice, sem in scored[:self.max_per_phrase]]
+
+def learn_lexical_semantics(domain, seed=None, lazy=False, max_per_phrase=10, min_count=1):
+    """
+    Trains and tests a model for the given domain whose lexical rules pair each
+    phrase with the semantics of every lexical rule with the same LHS, so that
+    the lexicon must be learned.  By default, the pairs are added to the grammar
+    by cartesian_product_of_lexical_rules().  If lazy is true, they are
+    instead generated during parsing by a LazyLexiconAnnotator, with the given
+    max_per_phrase and min_count.
+    """
     from parsing import Grammar
     print('#' * 80)
     print('Learn lexical semantics experiment for domain: %s\n' % domain.__class__.__name__)
     original_grammar = domain.grammar()
-    expanded_rules = cartesian_product_of_lexical_rules(domain.rules())
-    grammar = Grammar(rules=expanded_rules,
-                      annotators=original_grammar.annotators,
-                      start_symbol=original_grammar.start_symbol)
+    if lazy:
+        rules = [rule for rule in domain.rules() if not is_lexical(rule)]
+        lexicon = LazyLexiconAnnotator(domain.rules(), domain.train_examples(),
+                                       max_per_phrase=max_per_phrase, min_count=min_count)
+        annotators = original_grammar.annotators + [lexicon]
+    else:
+        rules = cartesian_product_of_lexical_rules(domain.rules())
+        annotators = original_grammar.annotators
+    grammar = Grammar(rules=rules,
+                      annotators=annotators,
+                      start_symbol=original_grammar.start_symbol,
+                      canonicalize=original_grammar.canonicalize)
     model = Model(grammar=grammar,
                   feature_fn=domain.features,
                   weights=domain.weights,
-                  executor=domain.execute)
+                  executor=domain.execute,
+                  batch_executor=domain.execute_batch)
     train_test(model=model,
                train_examples=domain.train_examples(),
                test_examples=domain.test_examples(),
@@ -315,14 +626,17 @@ def generate(rules, start_symbol='$ROOT', n=100, min_tokens=3, max_tokens=10):
     for input in inputs:
         print(input)
 
-def find_best_rules(domain):
+def find_best_rules(domain, correctness_cache=None):
     model = domain.model()
     examples = domain.train_examples()
     metric = domain.training_metric()
+    if correctness_cache is None:
+        correctness_cache = CorrectnessCache()
     rule_counts = defaultdict(int)
     for example in examples:
         parses = model.parse_input(example.input)
-        good_parses = [p for p in parses if metric.evaluate(example, [p])]
+        correct = correctness_cache.correct(metric, example, parses)
+        good_parses = [p for p, c in zip(parses, correct) if c]
         if good_parses:
             best_parse = good_parses[0]
             features = rule_features(best_parse)
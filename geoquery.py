@@ -26,7 +26,7 @@ from experiment import evaluate_for_domain, test_executor, evaluate_model, sampl
 from metrics import denotation_match_metrics, DenotationAccuracyMetric, DenotationOracleAccuracyMetric
 from geo880 import geo880_train_examples, geo880_test_examples
 from geobase import GeobaseReader
-from graph_kb import GraphKB, GraphKBExecutor
+from graph_kb import GraphKB, GraphKBExecutor, QueryCanonicalizer
 from parsing import Grammar, Rule
 from scoring import rule_features
 
@@ -54,7 +54,9 @@ def reverse(relation_sem):
 class GeoQueryDomain(Domain):
     def __init__(self):
         self.geobase = GraphKB(GeobaseReader().tuples)
-        self.geobase_executor = GraphKBExecutor(self.geobase)
+        # Shared by the executor, the grammar and the metrics.
+        self.canonicalizer = QueryCanonicalizer()
+        self.geobase_executor = GraphKBExecutor(self.geobase, canonicalizer=self.canonicalizer)
 
     def train_examples(self):
         return geo880_train_examples
@@ -470,13 +472,17 @@ class GeoQueryDomain(Domain):
         return weights
 
     def grammar(self):
-        return Grammar(rules=self.rules(), annotators=self.annotators())
+        return Grammar(rules=self.rules(), annotators=self.annotators(),
+                       canonicalize=self.canonicalizer)
 
     def execute(self, semantics):
         return self.geobase_executor.execute(semantics)
 
+    def execute_batch(self, semantics_list):
+        return self.geobase_executor.execute_batch(semantics_list)
+
     def metrics(self):
-        return denotation_match_metrics()
+        return denotation_match_metrics(canonicalize=self.canonicalizer)
 
     def training_metric(self):
         return DenotationAccuracyMetric()
@@ -1,13 +1,32 @@
 """
-This file defines two classes:
+This file defines these classes:
+
+  - BaseGraphKB holds what GraphKB and CompactGraphKB share: the interning of
+    values as integer ids, unary relations, and the caching of extrema.
 
   - GraphKB is a generic graph-structured knowledge base, or equivalently,
     a set of relational pairs and triples, with indexing for fast lookups.
 
+  - CompactGraphKB is an alternative to GraphKB for large knowledge bases.
+    It stores relations as arrays (which requires NumPy), one CSRAdjacency
+    for each direction of each binary relation.
+
   - GraphKBExecutor executes queries against a GraphKB.  It defines a simple
     query language, and responds to queries with (possibly empty) sets of
     values from the GraphKB.
 
+  - SubqueryCache is an LRU cache of the values of subqueries, which
+    GraphKBExecutor uses to avoid re-executing subqueries shared by many
+    queries (for example, by the many parses of an input).
+
+  - QueryCanonicalizer maps queries to canonical forms, so that equivalent
+    queries (such as conjunctions in different orders) can share cache
+    entries, chart items, and so on.
+
+  - RangePredicate and NodeSet are the internal values of queries in
+    GraphKBExecutor: the predicates denoted by ('.gt', X) and so on, and sets
+    of values represented as bitsets over node ids.
+
 The primary use case for these classes within SippyCup is to provide an executor
 backed by Geobase for use with the GeoQuery domain.  However, these classes are
 generic enough that they could be used for other applications.  For example,
@@ -27,10 +46,70 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
-from collections import defaultdict, Iterable
-from types import FunctionType
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from functools import partial
 
-class GraphKB:
+class BaseGraphKB:
+    """
+    The part of a knowledge base which GraphKB and CompactGraphKB have in
+    common.  Values are interned as integer ids, so that GraphKBExecutor can
+    represent sets of them as bitsets, and unary relations are kept as sets
+    of values.  Subclasses index binary relations, and define binary_pairs()
+    and the methods of GraphKB used by GraphKBExecutor (join() and so on).
+    """
+    def __init__(self):
+        self.ids = {}     # value => id
+        self.values = []  # id => value (or None, if the id is free)
+        self.free_ids = []  # ids released by GraphKB.remove_node(), to be reused
+        self.unaries = defaultdict(set)
+        self.unary_bits_cache = {}  # rel => bitset
+        self.sorted_cache = {}      # (rel, rev) => see sorted_index()
+        self.extrema_cache = {}     # (rel, unary, maximize) => (value, bitset)
+        # Incremented by every change, so that executors can invalidate caches.
+        self.version = 0
+
+    def intern(self, value):
+        if value not in self.ids:
+            if self.free_ids:
+                self.ids[value] = self.free_ids.pop()
+                self.values[self.ids[value]] = value
+            else:
+                self.ids[value] = len(self.values)
+                self.values.append(value)
+        return self.ids[value]
+
+    def unary_bits(self, rel):
+        """Returns the bitset of the nodes belonging to unary relation rel."""
+        if rel not in self.unary_bits_cache:
+            self.unary_bits_cache[rel] = ids_to_bits(
+                [self.ids[node] for node in self.unaries.get(rel, ())])
+        return self.unary_bits_cache[rel]
+
+    def extremum(self, rel, bits, maximize, unary=None):
+        """
+        See find_extremum().  If the given bitset is that of the given unary
+        relation, the result is cached.
+        """
+        if unary is None:
+            return find_extremum(self, rel, bits, maximize)
+        if (rel, unary, maximize) not in self.extrema_cache:
+            self.extrema_cache[(rel, unary, maximize)] = find_extremum(self, rel, bits, maximize)
+        return self.extrema_cache[(rel, unary, maximize)]
+
+    def list(self):
+        for rel in sorted(list(self.unaries.keys())):
+            for node in sorted(list(self.unaries[rel])):
+                print("(%s %s)" % (rel, node))
+        for rel in sorted(self.binary_relations()):
+            for src, dst in sorted(self.binary_pairs(rel)):
+                print("(%s %s %s)" % (rel, src, dst))
+
+    def executor(self):
+        return GraphKBExecutor(self)
+
+
+class GraphKB(BaseGraphKB):
     """
     Represents a knowledge base as set of tuples, each either:
 
@@ -69,41 +148,502 @@ class GraphKB:
         ('has_mother', 'bart', 'marge')
         ('has_mother', 'lisa', 'marge')
         ('has_mother', 'maggie', 'marge'),
+
+    Tuples can also be added and removed later, with add(), remove() and
+    update(), which keep all the indexes up to date.
     """
+    # In update(), relations with more changes than this have their derived
+    # indexes rebuilt, rather than updated for each change.
+    rebuild_threshold = 64
+
     def __init__(self, tuples):
+        super().__init__()
         self.nodes = set()
-        self.unaries = defaultdict(set)
+        self.node_counts = defaultdict(int)  # node => number of places in tuples
         self.binaries_fwd = defaultdict(lambda : defaultdict(set))  # rel => src => {dst}
         self.binaries_rev = defaultdict(lambda : defaultdict(set))  # rel => dst => {src}
+        self.all_bits_cache = None
+        self.adjacency_cache = {}   # (rel, rev) => (src id => [dst ids], bitset of src ids)
+        self.pair_counts = defaultdict(int)  # rel => number of pairs
+        for tuple in tuples:
+            self.add(tuple)
+
+    def add(self, tuple):
+        """Adds the given tuple, if it is not already present."""
+        if len(tuple) == 2:
+            self.add_unary(tuple)
+        elif len(tuple) == 3:
+            self.add_binary(tuple)
+        else:
+            assert False, 'Invalid tuple'
+
+    def remove(self, tuple):
+        """Removes the given tuple, if it is present."""
+        if len(tuple) == 2:
+            self.remove_unary(tuple)
+        elif len(tuple) == 3:
+            self.remove_binary(tuple)
+        else:
+            assert False, 'Invalid tuple'
+
+    def update(self, added=(), removed=()):
+        """
+        Removes the tuples in removed, and then adds the tuples in added (so a
+        changed fact can be given as its old and new tuples).  The derived
+        indexes (bitsets, sorted indexes, and so on) of relations with many
+        changes are discarded, to be rebuilt when next needed, rather than
+        updated change by change.
+        """
+        added, removed = list(added), list(removed)
+        changes = defaultdict(int)
+        for tuple in added + removed:
+            changes[tuple[0]] += 1
+        for rel, count in changes.items():
+            if count > self.rebuild_threshold:
+                self.invalidate(rel)
+        for tuple in removed:
+            self.remove(tuple)
+        for tuple in added:
+            self.add(tuple)
+
+    def invalidate(self, rel):
+        """Discards the derived indexes of relation rel."""
+        self.unary_bits_cache.pop(rel, None)
+        for rev in (False, True):
+            self.adjacency_cache.pop((rel, rev), None)
+            self.sorted_cache.pop((rel, rev), None)
+        self.invalidate_extrema(rel)
+
+    def invalidate_extrema(self, rel):
+        if self.extrema_cache:
+            for key in [key for key in self.extrema_cache if rel in key[:2]]:
+                del self.extrema_cache[key]
+
+    def add_unary(self, tuple):
+        rel, node = tuple
+        if node in self.unaries.get(rel, ()):
+            return
+        self.unaries[rel].add(node)
+        id = self.add_node(node)
+        if rel in self.unary_bits_cache:
+            self.unary_bits_cache[rel] |= 1 << id
+        self.invalidate_extrema(rel)
+        self.version += 1
+
+    def remove_unary(self, tuple):
+        rel, node = tuple
+        if node not in self.unaries.get(rel, ()):
+            return
+        self.unaries[rel].remove(node)
+        if not self.unaries[rel]:
+            del self.unaries[rel]
+        if rel in self.unary_bits_cache:
+            self.unary_bits_cache[rel] &= ~(1 << self.ids[node])
+        self.remove_node(node)
+        self.invalidate_extrema(rel)
+        self.version += 1
+
+    def add_binary(self, tuple):
+        rel, src, dst = tuple
+        if dst in self.binaries_fwd.get(rel, {}).get(src, ()):
+            return
+        self.binaries_fwd[rel][src].add(dst)
+        self.binaries_rev[rel][dst].add(src)
+        self.pair_counts[rel] += 1
+        src_id, dst_id = self.add_node(src), self.add_node(dst)
+        # (There are no indexes to update while the GraphKB is being built.)
+        if self.adjacency_cache or self.sorted_cache:
+            self.index_pair(rel, src_id, dst_id)
+        self.invalidate_extrema(rel)
+        self.version += 1
+
+    def remove_binary(self, tuple):
+        rel, src, dst = tuple
+        if dst not in self.binaries_fwd.get(rel, {}).get(src, ()):
+            return
+        for index, key, value in ((self.binaries_fwd, src, dst), (self.binaries_rev, dst, src)):
+            index[rel][key].remove(value)
+            if not index[rel][key]:
+                del index[rel][key]
+            if not index[rel]:
+                del index[rel]
+        self.pair_counts[rel] -= 1
+        if not self.pair_counts[rel]:
+            del self.pair_counts[rel]
+        self.unindex_pair(rel, self.ids[src], self.ids[dst])
+        self.remove_node(src)
+        self.remove_node(dst)
+        self.invalidate_extrema(rel)
+        self.version += 1
+
+    def index_pair(self, rel, src_id, dst_id):
+        """Adds a new pair of binary relation rel to its derived indexes."""
+        for rev, key, value in ((False, src_id, dst_id), (True, dst_id, src_id)):
+            if (rel, rev) in self.adjacency_cache:
+                adjacency, keys = self.adjacency_cache[(rel, rev)]
+                adjacency.setdefault(key, []).append(value)
+                self.adjacency_cache[(rel, rev)] = (adjacency, keys | 1 << key)
+            if self.sorted_cache.get((rel, rev)):
+                srcs, dsts = self.sorted_cache[(rel, rev)]
+                try:
+                    i = bisect_right(srcs, self.values[key])
+                    srcs.insert(i, self.values[key])
+                    dsts.insert(i, value)
+                except TypeError:
+                    self.sorted_cache[(rel, rev)] = None
+
+    def unindex_pair(self, rel, src_id, dst_id):
+        """Removes a pair of binary relation rel from its derived indexes."""
+        for rev, key, value in ((False, src_id, dst_id), (True, dst_id, src_id)):
+            if (rel, rev) in self.adjacency_cache:
+                adjacency, keys = self.adjacency_cache[(rel, rev)]
+                adjacency[key].remove(value)
+                if not adjacency[key]:
+                    del adjacency[key]
+                    keys &= ~(1 << key)
+                self.adjacency_cache[(rel, rev)] = (adjacency, keys)
+            if self.sorted_cache.get((rel, rev)):
+                srcs, dsts = self.sorted_cache[(rel, rev)]
+                start = bisect_left(srcs, self.values[key])
+                i = dsts.index(value, start, bisect_right(srcs, self.values[key]))
+                del srcs[i]
+                del dsts[i]
+            else:
+                # Without the removed value, the srcs might now be ordered.
+                self.sorted_cache.pop((rel, rev), None)
+
+    def add_node(self, node):
+        """Counts a new place of the given node in a tuple, and returns its id."""
+        id = self.intern(node)
+        self.node_counts[node] += 1
+        if self.node_counts[node] == 1:
+            self.nodes.add(node)
+            if self.all_bits_cache is not None:
+                self.all_bits_cache |= 1 << id
+        return id
+
+    def remove_node(self, node):
+        """
+        Uncounts a place of the given node in a tuple.  If it was the last,
+        the node is forgotten, and its id is released for reuse by intern(),
+        so that bitsets stay as wide as the number of nodes, rather than the
+        number of changes.  (Its bit has already been cleared from all the
+        indexes, along with the tuple.)
+        """
+        self.node_counts[node] -= 1
+        if self.node_counts[node] == 0:
+            del self.node_counts[node]
+            self.nodes.remove(node)
+            id = self.ids.pop(node)
+            if self.all_bits_cache is not None:
+                self.all_bits_cache &= ~(1 << id)
+            self.values[id] = None
+            self.free_ids.append(id)
+
+    def all_bits(self):
+        """Returns the bitset of all nodes."""
+        if self.all_bits_cache is None:
+            self.all_bits_cache = ids_to_bits(list(self.ids.values()))
+        return self.all_bits_cache
+
+    def has_binary(self, rel):
+        return rel in self.binaries_fwd
+
+    def adjacency(self, rel, rev=False):
+        """
+        Returns binaries_fwd[rel] (or binaries_rev[rel]) over ids, together with
+        the bitset of its keys.
+        """
+        if (rel, rev) not in self.adjacency_cache:
+            index = (self.binaries_rev if rev else self.binaries_fwd).get(rel, {})
+            adjacency = dict((self.ids[src], [self.ids[dst] for dst in dsts])
+                             for src, dsts in index.items() if dsts)
+            self.adjacency_cache[(rel, rev)] = (adjacency, ids_to_bits(list(adjacency.keys())))
+        return self.adjacency_cache[(rel, rev)]
+
+    def key_bits(self, rel, rev=False):
+        """Returns the bitset of the nodes which have binary relation rel (in the given direction)."""
+        return self.adjacency(rel, rev)[1]
+
+    def relation_stats(self, rel, rev=False):
+        """
+        Returns a pair of the number of nodes which have binary relation rel (in
+        the given direction) and the number of its pairs, for query planning.
+        """
+        return len(self.adjacency(rel, rev)[0]), self.pair_counts.get(rel, 0)
+
+    def join(self, rel, bits, rev=False):
+        """
+        Returns the bitset of the nodes to which any node in the given bitset has
+        binary relation rel, or if rev is true, which have relation rel to any
+        node in it.
+        """
+        adjacency, keys = self.adjacency(rel, rev)
+        # Only visit nodes which have the relation, which matters for large sets.
+        return ids_to_bits([dst for src in bits_to_ids(bits & keys) for dst in adjacency[src]])
+
+    def probe(self, rel, bits, targets, rev=False):
+        """
+        Returns the bitset of the nodes in the given bitset which have binary
+        relation rel (or if rev is true, its inverse) to any node in the bitset
+        targets.  This is the same as bits & join(rel, targets, not rev), but
+        visits only the pairs of the given nodes.
+        """
+        adjacency, keys = self.adjacency(rel, rev)
+        return ids_to_bits([src for src in bits_to_ids(bits & keys)
+                            if any(targets >> dst & 1 for dst in adjacency[src])])
+
+    def probe_predicate(self, rel, bits, predicate, rev=False):
+        """Like probe(), but for the nodes which satisfy the given predicate."""
+        adjacency, keys = self.adjacency(rel, rev)
+        return ids_to_bits([src for src in bits_to_ids(bits & keys)
+                            if any(predicate(self.values[dst]) for dst in adjacency[src])])
+
+    def sorted_index(self, rel, rev=False):
+        """
+        Returns a pair of parallel lists: the srcs of all the (src, dst) pairs in
+        binaries_fwd[rel] (or binaries_rev[rel]), in sorted order, and the ids
+        of their dsts.  The srcs which satisfy a RangePredicate then form a
+        contiguous slice.  Returns None if the srcs cannot be ordered, e.g.,
+        because they mix strings and numbers.
+        """
+        if (rel, rev) not in self.sorted_cache:
+            index = (self.binaries_rev if rev else self.binaries_fwd).get(rel, {})
+            pairs = [(src, self.ids[dst]) for src, dsts in index.items() for dst in dsts]
+            try:
+                pairs.sort(key=lambda pair: pair[0])
+                self.sorted_cache[(rel, rev)] = ([src for src, dst in pairs],
+                                                 [dst for src, dst in pairs])
+            except TypeError:
+                self.sorted_cache[(rel, rev)] = None
+        return self.sorted_cache[(rel, rev)]
+
+    def join_predicate(self, rel, predicate, rev=False):
+        """
+        Like join(), but for all the nodes which satisfy the given predicate,
+        e.g., the result of executing ('.gt', 5044).  Uses sorted_index() for
+        RangePredicates, and otherwise tests every node with the relation.
+        (So does a RangePredicate whose value cannot be compared with the
+        nodes, so that '.eq' matches none of them, and '.gt' and '.lt' raise
+        the usual errors.)
+        """
+        bounds = range_bounds(predicate, self.sorted_index(rel, rev))
+        if bounds:
+            start, end = bounds
+            return ids_to_bits(self.sorted_index(rel, rev)[1][start:end])
+        index = (self.binaries_rev if rev else self.binaries_fwd).get(rel, {})
+        return ids_to_bits([self.ids[dst]
+                            for src, dsts in index.items() if dsts and predicate(src)
+                            for dst in dsts])
+
+    def pairs(self, rel, bits):
+        """
+        Returns a list of the (src id, dst) pairs in binary relation rel whose
+        src is in the given bitset.
+        """
+        adjacency, keys = self.adjacency(rel)
+        return [(src, self.values[dst]) for src in bits_to_ids(bits & keys) for dst in adjacency[src]]
+
+    def binary_relations(self):
+        return list(self.binaries_fwd.keys())
+
+    def binary_pairs(self, rel):
+        """Returns a list of the (src, dst) pairs in binary relation rel."""
+        return [(src, dst) for src, dsts in self.binaries_fwd[rel].items() for dst in dsts]
+
+
+class CompactGraphKB(BaseGraphKB):
+    """
+    A GraphKB for large knowledge bases, with millions of triples.  Rather than
+    indexing binary relations with dicts of sets of arbitrary values, it
+    stores both directions of each binary relation as CSRAdjacency arrays of
+    node ids.  Joins are then vectorized gathers, and bitsets are converted
+    to and from arrays of ids with NumPy.  Unary relations are kept as sets of
+    values, as in GraphKB.
+
+    It supports the same queries as GraphKB (through GraphKBExecutor), but
+    not the binaries_fwd and binaries_rev dicts.  Requires NumPy.
+    """
+    def __init__(self, tuples):
+        import numpy as np
+        # A CompactGraphKB does not change, so its version is always 0.
+        super().__init__()
+        self.key_bits_cache = {}
+        pairs = defaultdict(lambda : ([], []))  # rel => ([src ids], [dst ids])
         for tuple in tuples:
             if len(tuple) == 2:
-                self.add_unary(tuple)
+                self.intern(tuple[1])
+                self.unaries[tuple[0]].add(tuple[1])
             elif len(tuple) == 3:
-                self.add_binary(tuple)
+                srcs, dsts = pairs[tuple[0]]
+                srcs.append(self.intern(tuple[1]))
+                dsts.append(self.intern(tuple[2]))
             else:
                 assert False, 'Invalid tuple'
+        self.binaries = {}  # rel => (fwd CSRAdjacency, rev CSRAdjacency)
+        for rel, (srcs, dsts) in list(pairs.items()):
+            srcs, dsts = np.array(srcs, dtype=np.int64), np.array(dsts, dtype=np.int64)
+            self.binaries[rel] = (CSRAdjacency(srcs, dsts), CSRAdjacency(dsts, srcs))
 
-    def add_unary(self, tuple):
-        self.nodes.add(tuple[1])
-        self.unaries[tuple[0]].add(tuple[1])
+    @property
+    def nodes(self):
+        return self.ids.keys()
 
-    def add_binary(self, tuple):
-        self.nodes.add(tuple[1])
-        self.nodes.add(tuple[2])
-        self.binaries_fwd[tuple[0]][tuple[1]].add(tuple[2])
-        self.binaries_rev[tuple[0]][tuple[2]].add(tuple[1])
+    def all_bits(self):
+        return (1 << len(self.values)) - 1
 
-    def list(self):
-        for rel in sorted(list(self.unaries.keys())):
-            for node in sorted(list(self.unaries[rel])):
-                print("(%s %s)" % (rel, node))
-        for rel in sorted(list(self.binaries_fwd.keys())):
-            for src in sorted(list(self.binaries_fwd[rel])):
-                for dst in sorted(list(self.binaries_fwd[rel][src])):
-                    print("(%s %s %s)" % (rel, src, dst))
+    def has_binary(self, rel):
+        return rel in self.binaries
 
-    def executor(self):
-        return GraphKBExecutor(self)
+    def key_bits(self, rel, rev=False):
+        if (rel, rev) not in self.key_bits_cache:
+            self.key_bits_cache[(rel, rev)] = array_to_bits(self.binaries[rel][1 if rev else 0].keys)
+        return self.key_bits_cache[(rel, rev)]
+
+    def relation_stats(self, rel, rev=False):
+        adjacency = self.binaries[rel][1 if rev else 0]
+        return len(adjacency.keys), len(adjacency.targets)
+
+    def join(self, rel, bits, rev=False):
+        """See GraphKB.join()."""
+        adjacency = self.binaries[rel][1 if rev else 0]
+        return array_to_bits(adjacency.gather(bits_to_array(bits))[1])
+
+    def probe(self, rel, bits, targets, rev=False):
+        """See GraphKB.probe()."""
+        import numpy as np
+        srcs, dsts = self.binaries[rel][1 if rev else 0].gather(bits_to_array(bits))
+        return array_to_bits(srcs[np.isin(dsts, bits_to_array(targets))])
+
+    def probe_predicate(self, rel, bits, predicate, rev=False):
+        """See GraphKB.probe_predicate()."""
+        import numpy as np
+        srcs, dsts = self.binaries[rel][1 if rev else 0].gather(bits_to_array(bits))
+        return array_to_bits(srcs[np.array([predicate(self.values[d]) for d in dsts.tolist()],
+                                           dtype=bool)])
+
+    def sorted_index(self, rel, rev=False):
+        """
+        See GraphKB.sorted_index().  Here, the ids of the dsts are an array.
+        """
+        if (rel, rev) not in self.sorted_cache:
+            adjacency = self.binaries[rel][1 if rev else 0]
+            key_values = [self.values[k] for k in adjacency.keys.tolist()]
+            try:
+                order = sorted(range(len(key_values)), key=key_values.__getitem__)
+                srcs, dsts = adjacency.gather(adjacency.keys[order])
+                self.sorted_cache[(rel, rev)] = ([self.values[k] for k in srcs.tolist()], dsts)
+            except TypeError:
+                self.sorted_cache[(rel, rev)] = None
+        return self.sorted_cache[(rel, rev)]
+
+    def join_predicate(self, rel, predicate, rev=False):
+        """See GraphKB.join_predicate()."""
+        import numpy as np
+        bounds = range_bounds(predicate, self.sorted_index(rel, rev))
+        if bounds:
+            start, end = bounds
+            return array_to_bits(self.sorted_index(rel, rev)[1][start:end])
+        adjacency = self.binaries[rel][1 if rev else 0]
+        keys = adjacency.keys[np.array([predicate(self.values[k])
+                                        for k in adjacency.keys.tolist()], dtype=bool)]
+        return array_to_bits(adjacency.gather(keys)[1])
+
+    def pairs(self, rel, bits):
+        """See GraphKB.pairs()."""
+        srcs, dsts = self.binaries[rel][0].gather(bits_to_array(bits))
+        return list(zip(srcs.tolist(), [self.values[d] for d in dsts.tolist()]))
+
+    def binary_relations(self):
+        return list(self.binaries.keys())
+
+    def binary_pairs(self, rel):
+        """See GraphKB.binary_pairs()."""
+        srcs, dsts = self.binaries[rel][0].gather(self.binaries[rel][0].keys)
+        return [(self.values[s], self.values[d]) for s, d in zip(srcs.tolist(), dsts.tolist())]
+
+class CSRAdjacency:
+    """
+    One direction of a binary relation over integer ids, in compressed sparse
+    row form: the sorted distinct source ids (keys), and for the i-th of them,
+    its sorted target ids targets[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, srcs, dsts):
+        import numpy as np
+        order = np.lexsort((dsts, srcs))
+        srcs, dsts = srcs[order], dsts[order]
+        # Drop duplicate pairs.
+        if len(srcs):
+            distinct = np.ones(len(srcs), dtype=bool)
+            distinct[1:] = (srcs[1:] != srcs[:-1]) | (dsts[1:] != dsts[:-1])
+            srcs, dsts = srcs[distinct], dsts[distinct]
+        self.keys, starts = np.unique(srcs, return_index=True)
+        self.offsets = np.append(starts, len(srcs)).astype(np.int64)
+        self.targets = dsts
+
+    def gather(self, ids):
+        """
+        Returns a pair of arrays (srcs, dsts) of all the pairs whose source is
+        one of the given ids.
+        """
+        import numpy as np
+        positions = np.searchsorted(self.keys, ids)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == ids[found]
+        positions = positions[found]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # The index in targets of each output, as a vectorized concatenation
+        # of the ranges [start, start + length).
+        total = int(lengths.sum())
+        run_starts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return np.repeat(ids[found], lengths), self.targets[run_starts + np.arange(total)]
+
+def find_extremum(graph_kb, rel, bits, maximize):
+    """
+    Returns a pair of the maximal (or minimal) value under binary relation rel
+    of any node in the given bitset (or -inf, or inf, if none of them has a
+    value), and the bitset of the nodes in it having that value.
+
+    If the set is large relative to the relation, we scan the pairs of the
+    relation sorted by value (see sorted_index()), from the extreme end, and
+    stop at the first node in the set.  Otherwise, it is cheaper to look up the
+    values of each node in the set.
+    """
+    # (Testing membership in a bitset would take time proportional to its size.)
+    members = set(bits_to_ids(bits & graph_kb.key_bits(rel)))
+    sorted_index = graph_kb.sorted_index(rel, rev=True) if members else None
+    if sorted_index and len(members) * len(members) > len(sorted_index[0]):
+        vals, ids = sorted_index
+        positions = range(len(vals) - 1, -1, -1) if maximize else range(len(vals))
+        first = next(i for i in positions if int(ids[i]) in members)
+        ext_val = vals[first]
+        ext_bits = ids_to_bits([int(ids[i])
+                                for i in range(bisect_left(vals, ext_val), bisect_right(vals, ext_val))
+                                if int(ids[i]) in members])
+        return ext_val, ext_bits
+    pairs = graph_kb.pairs(rel, bits)
+    vals = [val for e, val in pairs]
+    if maximize:
+        ext_val = max(vals) if pairs else float('-inf')
+    else:
+        ext_val = min(vals) if pairs else float('inf')
+    return ext_val, ids_to_bits([e for e, val in pairs if val == ext_val])
+
+def array_to_bits(ids):
+    """Returns the bitset of the given NumPy array of ids."""
+    import numpy as np
+    if not len(ids):
+        return 0
+    mask = np.zeros(((int(ids.max()) >> 3) + 1) * 8, dtype=bool)
+    mask[ids] = True
+    return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+def bits_to_array(bits):
+    """Returns a sorted NumPy array of the ids in the given bitset."""
+    import numpy as np
+    data = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) >> 3, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder='little'))
 
 
 class GraphKBExecutor:
@@ -111,6 +651,9 @@ class GraphKBExecutor:
     Executes formal queries against a GraphKB and returns their denotations.
     Queries are represented by Python tuples, and can be nested.
     Denotations are also represented by Python tuples, but are conceptually sets.
+    (Internally, sets are represented by NodeSets, which are converted to sorted
+    tuples only when execute() returns.  The complements produced by '.not' and
+    '.any' are represented symbolically, and are only expanded as needed.)
 
     The query language is perhaps most easily explained by example:
 
@@ -156,144 +699,674 @@ class GraphKBExecutor:
         ('.argmax', Q, X)   the subset of [[X]] having maximal values under relation Q
         ('.argmin', Q, X)   the subset of [[X]] having minimal values under relation Q
 
+    The values of (sub)queries are memoized in a SubqueryCache, keyed by their
+    canonical forms (see QueryCanonicalizer), which persists
+    across calls to execute() until the GraphKB changes, so subqueries shared
+    by the parses of an input, or by different inputs, are executed only once.
+    To limit sharing to a single input, clear the cache between inputs.  A
+    cache can also be shared by several executors.  execute_batch() executes
+    many queries at once, evaluating each distinct subquery exactly once.
+
+    Queries are compiled (see compile()) before they are executed, and the
+    compiled queries are cached too, so that executing a query again does not
+    repeat the dispatch on the types and operators of its subqueries.
+
+    With optimize=True, execute() instead plans the evaluation of '.and'
+    queries from statistics of the GraphKB (see plan_and()).  The denotations
+    are the same either way.
     """
-    def __init__(self, graph_kb):
+    # The method which executes each operator, with its keyword arguments.
+    operators = {
+        '.and': ('execute_and', {}),
+        '.or': ('execute_or', {}),
+        '.not': ('execute_not', {}),
+        '.any': ('execute_any', {}),
+        '.count': ('execute_count', {}),
+        '.gt': ('execute_gt', {}),
+        '.lt': ('execute_lt', {}),
+        '.eq': ('execute_eq', {}),
+        '.max': ('execute_max', {'rev': False, 'arg': False}),
+        '.min': ('execute_max', {'rev': True, 'arg': False}),
+        '.argmax': ('execute_max', {'rev': False, 'arg': True}),
+        '.argmin': ('execute_max', {'rev': True, 'arg': True}),
+    }
+
+    def __init__(self, graph_kb, cache=None, canonicalizer=None):
         self.graph_kb = graph_kb
+        self.cache = cache if cache is not None else SubqueryCache()
+        self.canonicalize = canonicalizer if canonicalizer is not None else QueryCanonicalizer()
+        self.compiled = SubqueryCache()  # sem => compiled query
+        self.pinned = None  # sem => value, during execute_batch()
+        self.planning = False
+
+    def execute(self, sem, optimize=False):
+        self.cache.validate(self.graph_kb)
+        return self.to_denotation(self.run(sem, optimize))
+
+    def execute_batch(self, sems, optimize=False):
+        """
+        Returns the list of the denotations of the given queries, such as the
+        semantics of all the parses of an input.  The queries are hash-consed:
+        equal queries, and equal subqueries of different queries, share one
+        node of a DAG, whose value is computed once and pinned for the rest of
+        the batch (even if the LRU cache evicts it).  Each distinct query (up
+        to canonical form) is also converted to a denotation only once.
+        """
+        self.cache.validate(self.graph_kb)
+        self.pinned = {}
+        try:
+            denotations = {}
+            keys = [self.canonicalize(sem) for sem in sems]
+            for sem, key in zip(sems, keys):
+                if key not in denotations:
+                    denotations[key] = self.to_denotation(self.run(sem, optimize))
+        finally:
+            self.pinned = None
+        return [denotations[key] for key in keys]
+
+    def to_denotation(self, value):
+        """Converts the given NodeSet (if it is one) to a sorted tuple."""
+        if isinstance(value, NodeSet):
+            return sorted_tuple(self.members(value))
+        return value
+
+    def members(self, node_set):
+        """Returns a list of the values in the given NodeSet."""
+        values = self.graph_kb.values
+        return [values[i] for i in bits_to_ids(self.node_bits(node_set))] + list(node_set.others)
+
+    def node_bits(self, node_set):
+        """Returns the bitset of the nodes in the given NodeSet."""
+        if node_set.complement:
+            return self.graph_kb.all_bits() & ~node_set.bits
+        return node_set.bits
+
+    def size(self, node_set):
+        if node_set.complement:
+            return len(self.graph_kb.nodes) - count_bits(node_set.bits) + len(node_set.others)
+        return count_bits(node_set.bits) + len(node_set.others)
+
+    def node_set(self, values):
+        """Returns the NodeSet of the given values."""
+        ids = self.graph_kb.ids
+        return NodeSet(ids_to_bits([ids[v] for v in values if v in ids]),
+                       frozenset([v for v in values if v not in ids]))
 
-    def execute(self, sem):
+    def as_node_set(self, arg):
+        if isinstance(arg, NodeSet):
+            return arg
+        elif isinstance(arg, str):
+            # A relation name, like any string, is taken as the set of its characters.
+            return self.node_set(arg)
+        raise TypeError('Not a set: %s' % str(arg))
+
+    def evaluate(self, sem):
+        """
+        Like execute(), but returns sets as NodeSets, not tuples.  The
+        execute_*() methods work with these internal values.
+        """
         if isinstance(sem, tuple):
-            return self.execute_tuple(sem)
+            return self.memoize(sem, partial(self.execute_tuple, sem))
         elif isinstance(sem, str) and sem.startswith('.'):
             return self.execute_special((sem,))
         elif sem in self.graph_kb.unaries:
             return self.execute_unary(sem)
-        elif sem in self.graph_kb.binaries_fwd:
+        elif self.graph_kb.has_binary(sem):
             # It's a relation name, so return it as is.
             return sem
         else:
-            # It's some other value (string, integer, ...), so return it as a tuple.
-            return (sem,)
+            # It's some other value (string, integer, ...), so return it as a set.
+            return self.node_set((sem,))
+
+    def memoize(self, sem, fn):
+        """
+        Returns the value of the tuple query sem: the value of its canonical
+        form pinned by execute_batch() or cached, if any, or else fn().
+        """
+        key = self.canonicalize(sem)
+        if self.pinned is not None and key in self.pinned:
+            return self.pinned[key]
+        if key in self.cache:
+            value = self.cache[key]
+        else:
+            value = fn()
+            self.cache[key] = value
+        if self.pinned is not None:
+            self.pinned[key] = value
+        return value
+
+    def run(self, sem, optimize=False):
+        """
+        Returns the (internal) value of sem, computed by plan() if optimize is
+        true (unless it raises UnplannableQuery), and otherwise by its
+        compiled query.
+        """
+        if optimize:
+            try:
+                return self.plan(sem)
+            except UnplannableQuery:
+                pass  # Let the compiled query raise the usual error.
+        return self.compiled_query(sem)()
+
+    def compiled_query(self, sem):
+        """Returns compile(sem), cached until the GraphKB changes."""
+        self.compiled.validate(self.graph_kb)
+        if sem in self.compiled:
+            return self.compiled[sem]
+        fn = self.compile(sem)
+        self.compiled[sem] = fn
+        return fn
+
+    def compile(self, sem):
+        """
+        Compiles the given query into a tree of closures: returns a function of
+        no arguments which returns the same value as evaluate(sem), but which
+        (with the functions for its subqueries, bound in advance) does no
+        dispatch on the form of the query.  The compiled query is only valid
+        until the GraphKB changes.
+
+        Subqueries which cannot be compiled are left to evaluate(), so that
+        any errors are raised when the query is executed, as usual.
+        """
+        try:
+            if isinstance(sem, tuple):
+                return partial(self.memoize, sem, self.compile_tuple(sem))
+            elif isinstance(sem, str) and sem.startswith('.'):
+                return self.compile_special((sem,))
+            elif sem in self.graph_kb.unaries:
+                return partial(self.execute_unary, sem)
+            elif self.graph_kb.has_binary(sem):
+                return lambda: sem
+            else:
+                value = self.node_set((sem,))
+                return lambda: value
+        except Exception:
+            return partial(self.evaluate, sem)
+
+    def compile_tuple(self, sem):
+        """Compiles the given tuple query, like execute_tuple()."""
+        if len(sem) == 1 and sem[0] in self.graph_kb.unaries:
+            return partial(self.execute_unary, sem[0])
+        elif len(sem) == 2 and self.graph_kb.has_binary(sem[0]):
+            rel, arg = sem[0], self.compile(sem[1])
+            return lambda: self.execute_binary(rel, arg(), rev=True)
+        elif len(sem) == 2 and self.graph_kb.has_binary(sem[1]):
+            rel, arg = sem[1], self.compile(sem[0])
+            return lambda: self.execute_binary(rel, arg(), rev=False)
+        elif sem[0].startswith('.'):
+            return self.compile_special(sem)
+        else:
+            return lambda: None
+
+    def compile_special(self, sem):
+        """Compiles the given query with an operator, like execute_special()."""
+        args = [self.compile(elt) for elt in sem[1:]]
+        if sem[0] not in self.operators:
+            return partial(self.execute_special, sem)
+        name, kwargs = self.operators[sem[0]]
+        method = partial(getattr(self, name), **kwargs)
+        return lambda: method(tuple([arg() for arg in args]))
+
+    def plan(self, sem):
+        """
+        Like evaluate(), but plans the evaluation of '.and' queries.  Raises
+        UnplannableQuery for malformed queries which it cannot inspect.
+        """
+        self.planning = True
+        try:
+            return self.evaluate(sem)
+        finally:
+            self.planning = False
+
+    def plan_and(self, x, y):
+        """
+        Executes ('.and', x, y) by evaluating whichever of x and y has the
+        smaller estimated size (see estimate()) and restricting the other to
+        the members of its value (see restrict()).
+        """
+        first, second = (y, x) if self.estimate(y) < self.estimate(x) else (x, y)
+        value = self.evaluate(first)
+        if isinstance(value, NodeSet) and not value.complement and not value.others:
+            return self.restrict(second, value.bits)
+        other = self.evaluate(second)
+        return self.execute_and((value, other) if first is x else (other, value))
+
+    def restrict(self, sem, bits, strict=False):
+        """
+        Returns the value of ('.and', sem, S), where S is the set of the nodes
+        in the given bitset, without computing all of the value of sem if it
+        is a unary relation, a join, or a combination of these.  If strict is
+        true, the value of sem must be a set, as for the arguments of '.or'.
+        """
+        kb = self.graph_kb
+        check_plannable(sem)
+        if isinstance(sem, tuple):
+            if len(sem) == 1 and sem[0] in kb.unaries:
+                return NodeSet(bits & kb.unary_bits(sem[0]))
+            elif len(sem) == 2 and kb.has_binary(sem[0]):
+                return self.restrict_join(sem[0], sem[1], bits, rev=True)
+            elif len(sem) == 2 and kb.has_binary(sem[1]):
+                return self.restrict_join(sem[1], sem[0], bits, rev=False)
+            elif sem[0] == '.and' and len(sem) == 3 and not is_predicate(sem[1]) \
+                    and not is_predicate(sem[2]):
+                # (A predicate must test all the members of the other argument,
+                # to raise the same errors, so such conjunctions are evaluated.)
+                first, second = sorted(sem[1:], key=self.estimate)
+                return self.restrict(second, self.restrict(first, bits).bits)
+            elif sem[0] == '.or' and len(sem) == 3:
+                return self.restrict(sem[1], bits, True) | self.restrict(sem[2], bits, True)
+            elif sem[0] == '.not' and len(sem) == 2:
+                return NodeSet(bits & ~self.restrict(sem[1], bits, True).bits)
+        elif not (isinstance(sem, str) and sem.startswith('.')) and sem in kb.unaries:
+            return NodeSet(bits & kb.unary_bits(sem))
+        value = self.evaluate(sem)
+        if strict:
+            return NodeSet(bits) & self.as_node_set(value)
+        return self.execute_and((NodeSet(bits), value))
+
+    def restrict_join(self, rel, x, bits, rev):
+        """
+        Returns restrict((rel, x), bits) if rev is true, or otherwise
+        restrict((x, rel), bits).  If it is cheaper, the nodes in the bitset
+        are probed for the relation in the opposite direction, rather than
+        joining the value of x with the relation.  Predicates are pushed into
+        the probe in the same way.
+        """
+        kb = self.graph_kb
+        arg = self.evaluate(x)
+        probe_cost = count_bits(bits & kb.key_bits(rel, not rev)) * self.fanout(rel, not rev)
+        if isinstance(arg, (NodeSet, str)):
+            arg_bits = self.node_bits(self.as_node_set(arg))
+            join_cost = count_bits(arg_bits & kb.key_bits(rel, rev)) * self.fanout(rel, rev)
+            if probe_cost < join_cost:
+                return NodeSet(kb.probe(rel, bits, arg_bits, not rev))
+        elif range_bounds(arg, kb.sorted_index(rel, rev)):
+            start, end = range_bounds(arg, kb.sorted_index(rel, rev))
+            if probe_cost < end - start:
+                return NodeSet(kb.probe_predicate(rel, bits, arg, not rev))
+        return NodeSet(bits) & self.execute_binary(rel, arg, rev)
+
+    def fanout(self, rel, rev=False):
+        """Returns the average number of pairs of binary relation rel per node having it."""
+        num_nodes, num_pairs = self.graph_kb.relation_stats(rel, rev)
+        return 1.0 * num_pairs / max(num_nodes, 1)
+
+    def estimate(self, sem):
+        """
+        Returns an estimate of the size of the value of sem, for plan_and(),
+        from the sizes of unary relations and the fan-outs of binary relations.
+        Predicates count as infinite, so that sets are evaluated before them.
+        """
+        kb = self.graph_kb
+        num_nodes = len(kb.nodes)
+        check_plannable(sem)
+        if isinstance(sem, tuple):
+            if len(sem) == 1 and sem[0] in kb.unaries:
+                return len(kb.unaries[sem[0]])
+            elif len(sem) == 2 and kb.has_binary(sem[0]):
+                return min(kb.relation_stats(sem[0])[0],
+                           self.estimate(sem[1]) * self.fanout(sem[0], rev=True))
+            elif len(sem) == 2 and kb.has_binary(sem[1]):
+                return min(kb.relation_stats(sem[1], rev=True)[0],
+                           self.estimate(sem[0]) * self.fanout(sem[1]))
+            elif sem[0] == '.and':
+                return min([self.estimate(arg) for arg in sem[1:]] + [num_nodes])
+            elif sem[0] == '.or':
+                return min(sum(self.estimate(arg) for arg in sem[1:]), num_nodes)
+            elif sem[0] == '.not' and len(sem) == 2:
+                return max(num_nodes - self.estimate(sem[1]), 0)
+            elif sem[0] in ('.count', '.max', '.min', '.argmax', '.argmin'):
+                return 1
+            elif is_predicate(sem):
+                return float('inf')
+            return num_nodes
+        elif isinstance(sem, str) and sem.startswith('.'):
+            return num_nodes
+        elif sem in kb.unaries:
+            return len(kb.unaries[sem])
+        return 1
 
     def execute_tuple(self, sem):
         if len(sem) == 1 and sem[0] in self.graph_kb.unaries:
             return self.execute_unary(sem[0])
-        elif len(sem) == 2 and sem[0] in self.graph_kb.binaries_fwd:
-            return self.execute_binary(sem[0], sem[1], rev=True)
-        elif len(sem) == 2 and sem[1] in self.graph_kb.binaries_fwd:
-            return self.execute_binary(sem[1], sem[0], rev=False)
+        elif len(sem) == 2 and self.graph_kb.has_binary(sem[0]):
+            return self.execute_binary(sem[0], self.evaluate(sem[1]), rev=True)
+        elif len(sem) == 2 and self.graph_kb.has_binary(sem[1]):
+            return self.execute_binary(sem[1], self.evaluate(sem[0]), rev=False)
         elif sem[0].startswith('.'):
+            if self.planning and sem[0] == '.and' and len(sem) == 3:
+                return self.plan_and(sem[1], sem[2])
             return self.execute_special(sem)
 
     def execute_unary(self, rel):
-        return sorted_tuple(self.graph_kb.unaries[rel])
+        return NodeSet(self.graph_kb.unary_bits(rel), unary=rel)
 
     def execute_binary(self, rel, arg, rev=False):
-        arg = self.execute(arg)
-        index = self.graph_kb.binaries_rev if rev else self.graph_kb.binaries_fwd
-        if isinstance(arg, Iterable):
-            # arg is a tuple, e.g., the result of executing '5044'.
-            vals = [src for dst in arg for src in index[rel][dst]]
-        elif isinstance(arg, FunctionType):
+        """Joins binary relation rel with arg, the value of a query."""
+        if isinstance(arg, (NodeSet, str)):
+            # arg is a set, e.g., the result of executing '5044'.  Values which
+            # are not nodes have no relations, so only its bits matter.
+            return NodeSet(self.graph_kb.join(rel, self.node_bits(self.as_node_set(arg)), rev))
+        elif isinstance(arg, RangePredicate):
             # arg is a predicate, e.g., the result of executing ('.gt', 5044).
-            vals = [src for dst, srcs in list(index[rel].items()) if arg(dst) for src in srcs]
+            return NodeSet(self.graph_kb.join_predicate(rel, arg, rev))
         else:
             raise Exception('Unsupported argument to join: %s' % str(arg))
-        return sorted_tuple(set(vals))
 
     def execute_special(self, sem):
-        args = tuple([self.execute(elt) for elt in sem[1:]])
-        if sem[0] == '.and':
-            return self.execute_and(args)
-        elif sem[0] == '.or':
-            return self.execute_or(args)
-        elif sem[0] == '.not':
-            return self.execute_not(args)
-        elif sem[0] == '.any':
-            return self.execute_any(args)
-        elif sem[0] == '.count':
-            return self.execute_count(args)
-        elif sem[0] == '.gt':
-            return self.execute_gt(args)
-        elif sem[0] == '.lt':
-            return self.execute_lt(args)
-        elif sem[0] == '.eq':
-            return self.execute_eq(args)
-        elif sem[0] == '.max':
-            return self.execute_max(args, rev=False, arg=False)
-        elif sem[0] == '.min':
-            return self.execute_max(args, rev=True, arg=False)
-        elif sem[0] == '.argmax':
-            return self.execute_max(args, rev=False, arg=True)
-        elif sem[0] == '.argmin':
-            return self.execute_max(args, rev=True, arg=True)
-        else:
+        args = tuple([self.evaluate(elt) for elt in sem[1:]])
+        if sem[0] not in self.operators:
             raise Exception('Unsupported operator: %s' % str(sem[0]))
+        name, kwargs = self.operators[sem[0]]
+        return getattr(self, name)(args, **kwargs)
 
     def execute_and(self, args):
         assert len(args) == 2
         # Check to see if either element of args is a predicate,
         # e.g., the result of executing ('.gt', 5044).
-        if isinstance(args[0], FunctionType):
+        if isinstance(args[0], RangePredicate):
             args = (args[1], args[0])
-        if isinstance(args[1], FunctionType):
-            return sorted_tuple([elt for elt in args[0] if args[1](elt)])
+        if isinstance(args[1], RangePredicate):
+            return self.node_set([elt for elt in self.members(self.as_node_set(args[0]))
+                                  if args[1](elt)])
         else:
-            return sorted_tuple(set(args[0]).intersection(set(args[1])))
+            return self.as_node_set(args[0]) & self.as_node_set(args[1])
 
     # TODO: Properly handle the case where one or both arguments are
     # functions, like execute_and() does.
     def execute_or(self, args):
         assert len(args) == 2
-        return sorted_tuple(set(args[0]).union(set(args[1])))
+        return self.as_node_set(args[0]) | self.as_node_set(args[1])
 
     def execute_not(self, args):
         assert len(args) == 1
-        complement = [node for node in self.graph_kb.nodes if node not in args[0]]
-        return sorted_tuple(complement)
+        return ~self.as_node_set(args[0])
 
     def execute_any(self, args):
         assert len(args) == 0
-        return self.execute_not(((),))
+        return self.execute_not((NodeSet(),))
 
     def execute_count(self, args):
         assert len(args) == 1
-        return (len(args[0]),)
+        return self.node_set((self.size(self.as_node_set(args[0])),))
 
     def execute_gt(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
-        max_val = max(args[0]) if args[0] else float('-inf')
-        return lambda x: x > max_val
+        assert isinstance(args[0], NodeSet), 'Not a set: %s' % str(args[0])
+        vals = self.members(args[0])
+        max_val = max(vals) if vals else float('-inf')
+        return RangePredicate('.gt', max_val)
 
     # TODO: consider ways of combining with execute_gt().
     def execute_lt(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
-        min_val = min(args[0]) if args[0] else float('inf')
-        return lambda x: x < min_val
+        assert isinstance(args[0], NodeSet), 'Not a set: %s' % str(args[0])
+        vals = self.members(args[0])
+        min_val = min(vals) if vals else float('inf')
+        return RangePredicate('.lt', min_val)
 
     def execute_eq(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
-        assert len(args[0]) == 1
-        return lambda x: x == args[0][0]
+        assert isinstance(args[0], NodeSet), 'Not a set: %s' % str(args[0])
+        assert self.size(args[0]) == 1
+        return RangePredicate('.eq', self.members(args[0])[0])
 
     def execute_max(self, args, rev=False, arg=False):
         assert len(args) == 2
         # TODO: Drop the assumption that the first argument is a relation from some entity
         # to a number.  What if it's the other way around?
-        index = self.graph_kb.binaries_fwd
-        assert args[0] in index, 'Not a relation name: %s' % str(args[0])
-        pairs = [(src, dst) for src in args[1] for dst in index[args[0]][src]]
-        vals = [val for e, val in pairs]
-        if rev:
-            ext_val = min(vals) if pairs else float('inf')
-        else:
-            ext_val = max(vals) if pairs else float('-inf')
+        assert self.graph_kb.has_binary(args[0]), 'Not a relation name: %s' % str(args[0])
+        node_set = self.as_node_set(args[1])
+        ext_val, ext_bits = self.graph_kb.extremum(
+            args[0], self.node_bits(node_set), not rev, node_set.unary)
         if arg:
-            return sorted_tuple(set([e for e, val in pairs if val == ext_val]))
+            return NodeSet(ext_bits)
+        else:
+            return self.node_set((ext_val,))
+
+class UnplannableQuery(Exception):
+    """
+    Raised by GraphKBExecutor.plan() for queries which it does not handle,
+    so that they are executed as usual (and raise the usual errors).
+    """
+
+class SubqueryCache:
+    """
+    An LRU cache of the values of subqueries (as returned by
+    GraphKBExecutor.evaluate()), with at most max_size entries, which counts
+    its hits and misses.  It is only valid for one version of one knowledge
+    base: validate() clears it if the knowledge base has changed.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.graph_kb = None
+        self.version = None
+
+    def validate(self, graph_kb):
+        if graph_kb is not self.graph_kb or graph_kb.version != self.version:
+            self.clear()
+            self.graph_kb = graph_kb
+            self.version = graph_kb.version
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, sem):
+        if sem in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(sem)
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, sem):
+        return self.entries[sem]
+
+    def __setitem__(self, sem, value):
+        self.entries[sem] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return 'SubqueryCache(%d entries, %d hits, %d misses)' % (
+            len(self.entries), self.hits, self.misses)
+
+class QueryCanonicalizer:
+    """
+    Maps queries to canonical forms: equivalent queries which differ only in
+    the order or nesting of the arguments of '.and' (or '.or') map to the same
+    query.  Nested conjunctions are flattened, their arguments are sorted, and
+    they are rebuilt as left-nested chains of binary conjunctions, so that
+    canonical queries can still be executed.  Predicates, such as
+    ('.gt', 5044), are sorted last, so that each applies to a set.  Canonical
+    subqueries are hash-consed: equal ones are the same object.
+
+    A predicate tests the members of the set it is conjoined with, and may
+    raise errors for some of them (e.g., comparing strings with numbers), so
+    a conjunction with a predicate argument is never flattened into another
+    conjunction: each predicate still tests exactly the same set.  Thus
+    queries with the same canonical form have the same value, or raise
+    errors alike, and caching by canonical form cannot change the results.
+
+    It remembers up to max_size queries, and then starts afresh.
+    """
+    associative = ('.and', '.or')
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        self.memo = {}      # query => canonical query
+        self.table = {}     # canonical query => itself
+        self.operands = {}  # canonical conjunction or disjunction => its flattened arguments
+
+    def __call__(self, sem):
+        if not isinstance(sem, tuple):
+            return sem
+        try:
+            if sem in self.memo:
+                return self.memo[sem]
+        except TypeError:
+            return sem  # Unhashable, and certainly not a valid query.
+        if len(self.memo) >= self.max_size:
+            self.clear()
+        canonical = self.memo[sem] = self.canonicalize(sem)
+        return canonical
+
+    def canonicalize(self, sem):
+        args = tuple([self(arg) for arg in sem])
+        if len(args) != 3 or args[0] not in self.associative:
+            return self.table.setdefault(args, args)
+        op = args[0]
+        operands = []
+        for arg in args[1:]:
+            nested = (arg,)
+            if isinstance(arg, tuple) and len(arg) == 3 and arg[0] == op:
+                nested = self.operands.get(arg, nested)
+                if op == '.and' and any(is_predicate(elt) for elt in nested):
+                    nested = (arg,)
+            operands.extend(nested)
+        operands.sort(key=lambda arg: (is_predicate(arg), repr(arg)))
+        canonical = operands[0]
+        for i in range(1, len(operands)):
+            canonical = self.table.setdefault((op, canonical, operands[i]), (op, canonical, operands[i]))
+            self.operands[canonical] = tuple(operands[:i + 1])
+        return canonical
+
+class RangePredicate:
+    """
+    The predicate denoted by ('.gt', X), ('.lt', X) or ('.eq', X): true of the
+    values x such that x > value, x < value, or x == value, respectively.
+    Unlike a lambda, it can be inspected, so that joins can find the values
+    satisfying it by binary search rather than by testing every value.
+    """
+    def __init__(self, op, value):
+        assert op in ('.gt', '.lt', '.eq'), 'Not a range operator: %s' % op
+        self.op = op
+        self.value = value
+
+    def __call__(self, x):
+        if self.op == '.gt':
+            return x > self.value
+        elif self.op == '.lt':
+            return x < self.value
         else:
-            return (ext_val,)
+            return x == self.value
+
+    def bounds(self, sorted_values):
+        """
+        Returns the (start, end) of the slice of the given sorted list of values
+        which satisfy this predicate.
+        """
+        if self.op == '.gt':
+            return bisect_right(sorted_values, self.value), len(sorted_values)
+        elif self.op == '.lt':
+            return 0, bisect_left(sorted_values, self.value)
+        else:
+            return bisect_left(sorted_values, self.value), bisect_right(sorted_values, self.value)
+
+    def __repr__(self):
+        return 'RangePredicate(%r, %r)' % (self.op, self.value)
+
+class NodeSet:
+    """
+    A set of values, represented as a bitset (a Python int) over the ids of
+    the nodes of a GraphKB, together with a frozenset of any values which are
+    not nodes, such as the results of counting.  If complement is true, the
+    set instead contains all the nodes except those in the bitset (plus the
+    other values), so that complements need not enumerate all nodes.
+    Intersection, union and complement are bitwise operations.
+
+    If the set is exactly a unary relation, unary is its name, so that
+    results computed from it (see BaseGraphKB.extremum()) can be cached.
+    """
+    __slots__ = ('bits', 'others', 'complement', 'unary')
+
+    def __init__(self, bits=0, others=frozenset(), complement=False, unary=None):
+        self.bits = bits
+        self.others = others
+        self.complement = complement
+        self.unary = unary
+
+    def __and__(self, other):
+        others = self.others & other.others
+        if self.complement and other.complement:
+            return NodeSet(self.bits | other.bits, others, True)
+        elif self.complement:
+            return NodeSet(other.bits & ~self.bits, others)
+        elif other.complement:
+            return NodeSet(self.bits & ~other.bits, others)
+        return NodeSet(self.bits & other.bits, others)
+
+    def __or__(self, other):
+        others = self.others | other.others
+        if self.complement and other.complement:
+            return NodeSet(self.bits & other.bits, others, True)
+        elif self.complement:
+            return NodeSet(self.bits & ~other.bits, others, True)
+        elif other.complement:
+            return NodeSet(other.bits & ~self.bits, others, True)
+        return NodeSet(self.bits | other.bits, others)
+
+    def __invert__(self):
+        """Returns the set of nodes not in this set.  Values which are not nodes are never included."""
+        return NodeSet(self.bits, frozenset(), not self.complement)
+
+def range_bounds(predicate, sorted_index):
+    """
+    Returns predicate.bounds() of the sorted values of the given sorted_index()
+    if predicate is a RangePredicate, or None if it is not, if there is no
+    sorted index, or if its value cannot be compared with the sorted values.
+    """
+    if not isinstance(predicate, RangePredicate) or not sorted_index:
+        return None
+    try:
+        return predicate.bounds(sorted_index[0])
+    except TypeError:
+        return None
+
+def check_plannable(sem):
+    """
+    Raises UnplannableQuery unless the given query is hashable, so that
+    GraphKBExecutor.plan() can look up its parts in the GraphKB.
+    """
+    try:
+        hash(sem)
+    except TypeError:
+        raise UnplannableQuery('Unhashable query: %s' % str(sem))
+
+def is_predicate(sem):
+    """Returns whether the given query denotes a predicate, like ('.gt', 5044)."""
+    return isinstance(sem, tuple) and len(sem) > 0 and sem[0] in ('.gt', '.lt', '.eq')
+
+def ids_to_bits(ids):
+    """Returns the bitset of the given list of ids."""
+    if not ids:
+        return 0
+    data = bytearray((max(ids) >> 3) + 1)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(data), 'little')
+
+def bits_to_ids(bits):
+    """Returns the sorted list of the ids in the given bitset."""
+    binary = bin(bits)[:1:-1]  # Least significant bit first.
+    ids = []
+    i = binary.find('1')
+    while i >= 0:
+        ids.append(i)
+        i = binary.find('1', i + 1)
+    return ids
+
+def count_bits(bits):
+    return bin(bits).count('1')
 
 def sorted_tuple(elements):
     return tuple(sorted(list(elements), key=str))
@@ -405,6 +1478,56 @@ def demo():
         print('%-16s %s' % ('input', example.input))
         print('%-16s %s' % ('semantics', example.semantics))
         print('%-16s %s' % ('denotation', deno))
+    print()
+
+    # The other ways of executing queries give the same denotations.
+    sems = [example.semantics for example in examples]
+    denotations = [example.denotation for example in examples]
+    assert [executor.execute(sem, optimize=True) for sem in sems] == denotations
+    assert graph_kb.executor().execute_batch(sems) == denotations
+    assert graph_kb.executor().execute_batch(sems, optimize=True) == denotations
+    print('Planned and batched execution agree')
+    try:
+        compact_executor = CompactGraphKB(tuples).executor()
+    except ImportError:
+        print('NumPy is not available, so skipping CompactGraphKB')
+    else:
+        assert [compact_executor.execute(sem) for sem in sems] == denotations
+        assert compact_executor.execute_batch(sems, optimize=True) == denotations
+        print('CompactGraphKB agrees')
+
+    # After changes, denotations are the same as with a GraphKB built from
+    # scratch.  (Abe is added and then removed again, so that the ids of Abe's
+    # nodes are reused by Mona's.)
+    abe = [('male', 'abe'), ('adult', 'abe'), ('has_age', 'abe', 83), ('has_father', 'homer', 'abe')]
+    mona = [('female', 'mona'), ('adult', 'mona'), ('has_age', 'mona', 80), ('has_mother', 'homer', 'mona')]
+    changes = [
+        ('add', abe, []),
+        ('update', [('has_age', 'homer', 37), ('has_age', 'bart', 11)],
+                   [('has_age', 'homer', 36), ('has_age', 'bart', 10)]),
+        ('remove', [], abe),
+        ('update', mona, [('child', 'maggie')]),
+    ]
+    for method, added, removed in changes:
+        if method == 'add':
+            for tuple in added:
+                graph_kb.add(tuple)
+        elif method == 'remove':
+            for tuple in removed:
+                graph_kb.remove(tuple)
+        else:
+            graph_kb.update(added, removed)
+        tuples = [tuple for tuple in tuples if tuple not in removed] + added
+        expected = GraphKB(tuples).executor()
+        for sem in sems:
+            deno = expected.execute(sem)
+            assert executor.execute(sem) == deno, str(sem) + ': ' + str(executor.execute(sem))
+            assert executor.execute(sem, optimize=True) == deno, str(sem)
+        assert executor.execute_batch(sems) == [expected.execute(sem) for sem in sems]
+        print('After %s: oldest thing is %s' % (
+            method, executor.execute(('.argmax', 'has_age', '.any'))))
+    # The ids of removed nodes have all been reused.
+    assert len(graph_kb.values) == len(graph_kb.ids)
 
 if __name__ == '__main__':
     demo()
@@ -6,12 +6,18 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+import gzip
+import heapq
 import math
+import os
+import pickle
 import random
+import re
 from collections import defaultdict, Counter
 import warnings
 
-from metrics import SemanticsAccuracyMetric, DenotationAccuracyMetric
+from metrics import CorrectnessCache, SemanticsAccuracyMetric, DenotationAccuracyMetric
+from parsing import ForestNode, forest_nodes, parse_forest
 from scoring import Model, score
 
 
@@ -24,7 +30,18 @@ def latent_sgd(
         seed=None,
         loss='hinge',
         l2_penalty=0.0,
-        epsilon=1e-7):
+        l1_penalty=0.0,
+        epsilon=1e-7,
+        reparse_every=None,
+        checkpoint_path=None,
+        checkpoint_every=1000,
+        checkpoint=None,
+        dev_examples=[],
+        dev_metric=None,
+        patience=3,
+        candidates_cache=None,
+        top_k=None,
+        correctness_cache=None):
     """
     Parameters
     ----------
@@ -44,19 +61,69 @@ def latent_sgd(
     l2_penalty : float
         L2 penalty constant to apply to each weight. If 0.0, then
         no penalty is imposed. Larger weights correspond to a stronger
-        penalty.
+        penalty. The penalty is applied lazily; see `LazyL2Penalty`.
+    l1_penalty : float
+        If nonzero, the weights of the features in each update are
+        truncated towards zero by this constant times their AdaGrad step
+        size, and removed once they reach it (truncated gradient).  The
+        zeroed features are pruned from the returned model.
     epsilon : float
         Tolerance for stopping learning. If either the total error
         or the adagrad magnitude drops below this, then learning
         is terminated.
+    reparse_every : int or None
+        If None, each example is parsed only once: its candidate parses are
+        cached together with their features and training-metric
+        correctness, and in later epochs they are merely rescored with the
+        current weights.  Since `Model.parse_input` never prunes candidates
+        by score, this gives the same results as reparsing, only faster.
+        If an int k, examples are reparsed every k epochs instead, which
+        is appropriate for grammars whose candidate sets depend on the
+        weights (e.g., via beam pruning).
+    checkpoint_path : str or None
+        If given, the training state is saved to this file at the end of
+        every epoch and every `checkpoint_every` examples, so that an
+        interrupted run can be continued with resume_latent_sgd().  When
+        learning stops early, a final checkpoint records the stop, and
+        resuming from it just returns the resulting model.
+    checkpoint_every : int
+        Number of examples between checkpoints within an epoch.
+    checkpoint : dict or None
+        Training state to resume from, as returned by load_checkpoint().
+        Normally, use resume_latent_sgd() rather than passing this directly.
+        The examples must be given in the same order as in the original run.
+    dev_examples : list of `example.Example`
+        If nonempty, accuracy on these examples is measured after every
+        epoch, and learning stops early once it has not improved for
+        `patience` epochs.  Either way, the weights from the epoch with the
+        best dev accuracy are returned.  The dev examples are parsed only
+        once, and merely rescored after each epoch.
+    dev_metric : `metric.Metric` or None
+        Metric used to judge the top candidate of each dev example.
+        Defaults to `training_metric`.
+    patience : int
+        Number of epochs without improvement in dev accuracy to tolerate.
+    candidates_cache : dict or None
+        Map from examples to their Candidates, as returned by
+        parse_candidates() for `training_metric`.  Missing entries are
+        filled in as needed.  Passing one in lets several runs share
+        the work of parsing.
+    top_k : int or None
+        If None, the loss-augmented prediction is chosen among all the
+        candidates of each example.  If an int k, it is chosen only among
+        the k highest-scoring candidates and the target, which are found
+        with a heap rather than by sorting all the candidates.  This is
+        exact for the maximal score when k >= 2, but ties beyond the top k
+        are not considered.
+    correctness_cache : `metrics.CorrectnessCache` or None
+        Cache of the correctness of candidates under the training and dev
+        metrics, which is kept for the whole run (so that reparsing need
+        not re-evaluate them), and which can be shared between runs.
 
     Returns
     -------
     Trained `scoring.Model` instance.
     """
-    # Used for sorting scored parses.
-    def scored_parse_key_fn(scored_parse):
-        return (scored_parse[0], str(scored_parse[1]))
     if T <= 0:
         return model
     if loss != 'hinge':
@@ -64,52 +131,295 @@ def latent_sgd(
     print('=' * 80)
     print('Running SGD learning on %d examples with training metric: %s\n' % (
         len(examples), training_metric.name()))
-    if seed:
+    if seed and not checkpoint:
         print('random.seed(%d)' % seed)
         random.seed(seed)
     model = clone_model(model)
     adagrad = defaultdict(float)
-    for t in range(T):
-        random.shuffle(examples)
-        num_correct = 0
-        ada_update_mag = 0.0
-        error = 0.0
-        for example in examples:
-            # Reparse with current weights.
-            parses = model.parse_input(example.input)
-            # Get the highest-scoring "good" parse among the candidate parses.
-            good_parses = [p for p in parses if training_metric.evaluate(example, [p])]
-            if good_parses:
-                target_parse = good_parses[0]
-                # Get all (score, parse) pairs.
-                scores = [(p.score + cost(target_parse, p), p) for p in parses]
+    lazy_l2 = LazyL2Penalty(l2_penalty, eta) if l2_penalty else None
+    # Checkpoints record the order of the examples as indices into this list.
+    original_examples = list(examples)
+    start_epoch, start_position = 0, 0
+    # Dev accuracy, epoch and weights of the best epoch so far.
+    best_dev_acc, best_epoch, best_weights = -1.0, -1, None
+    if checkpoint:
+        model.weights.update(checkpoint['weights'])
+        adagrad.update(checkpoint['adagrad'])
+        if lazy_l2:
+            lazy_l2.num_updates, num_penalized = checkpoint['lazy_l2']
+            lazy_l2.num_penalized.update(num_penalized)
+        examples[:] = [original_examples[i] for i in checkpoint['example_order']]
+        random.setstate(checkpoint['random_state'])
+        start_epoch, start_position = checkpoint['epoch'], checkpoint['position']
+        num_correct, ada_update_mag, error = checkpoint['totals']
+        best_dev_acc, best_epoch, best_weights = checkpoint['best']
+        if checkpoint.get('stopped'):
+            # The run stopped early, so there are no more epochs to run.
+            start_epoch = T
+    if correctness_cache is None:
+        correctness_cache = CorrectnessCache()
+    dev_candidates = [parse_candidates(model, example, dev_metric or training_metric,
+                                       correctness_cache)
+                      for example in dev_examples]
+    def save(t, position, stopped=False):
+        example_indices = dict((id(example), i) for i, example in enumerate(original_examples))
+        save_checkpoint(checkpoint_path, {
+            'params': {
+                'T': T,
+                'eta': eta,
+                'loss': loss,
+                'l2_penalty': l2_penalty,
+                'l1_penalty': l1_penalty,
+                'epsilon': epsilon,
+                'reparse_every': reparse_every,
+                'checkpoint_every': checkpoint_every,
+                'patience': patience,
+                'top_k': top_k,
+            },
+            'epoch': t,
+            'position': position,
+            'example_order': [example_indices[id(example)] for example in examples],
+            'random_state': random.getstate(),
+            'weights': model.weights,
+            'adagrad': adagrad,
+            'lazy_l2': (lazy_l2.num_updates, lazy_l2.num_penalized) if lazy_l2 else None,
+            'totals': (num_correct, ada_update_mag, error),
+            'best': (best_dev_acc, best_epoch, best_weights),
+            'stopped': stopped,
+        })
+    if candidates_cache is None:
+        candidates_cache = {}
+    for t in range(start_epoch, T):
+        if t > start_epoch or start_position == 0:
+            random.shuffle(examples)
+            num_correct = 0
+            ada_update_mag = 0.0
+            error = 0.0
+        reparse = reparse_every and t % reparse_every == 0
+        first_position = start_position if t == start_epoch else 0
+        for position in range(first_position, len(examples)):
+            if checkpoint_path and position > first_position and position % checkpoint_every == 0:
+                save(t, position)
+            example = examples[position]
+            if reparse or example not in candidates_cache:
+                candidates_cache[example] = parse_candidates(
+                    model, example, training_metric, correctness_cache)
+            if lazy_l2:
+                for candidate in candidates_cache[example]:
+                    lazy_l2.catch_up(model.weights, adagrad, candidate.features.keys())
+            if top_k:
+                # Rescore with current weights, and keep only the top k.
+                candidates = top_candidates(candidates_cache[example], model.weights, top_k)
+                good_candidates = top_candidates(
+                    [c for c in candidates_cache[example] if c.correct], model.weights, 1)
+                if good_candidates and good_candidates[0] not in candidates:
+                    candidates = candidates + good_candidates
+            else:
+                # Rescore with current weights.
+                candidates = rescore_candidates(candidates_cache[example], model.weights)
+                good_candidates = [c for c in candidates if c.correct]
+            # Get the highest-scoring "good" candidate.
+            if good_candidates:
+                target = good_candidates[0]
+                # Get all (score, candidate) pairs.
+                scores = [(c.parse.score + cost(target.parse, c.parse), c) for c in candidates]
                 # Get the maximal score.
-                max_score = sorted(scores, key=scored_parse_key_fn)[-1][0]
+                max_score = max(s for s, c in scores)
                 # Error:
-                error += max_score - target_parse.score
+                error += max_score - target.parse.score
                 # Get all the candidates with the max score and choose one randomly.
-                predicted_parse = random.choice([p for s, p in scores if s == max_score])
-                if training_metric.evaluate(example, parses):
+                predicted = random.choice([c for s, c in scores if s == max_score])
+                if candidates[0].correct:
                     num_correct += 1
-                ada_update_mag, adagrad = update_weights(
+                ada_update_mag, adagrad = update_weights_with_features(
                     model,
-                    target_parse,
-                    predicted_parse,
+                    target.features,
+                    predicted.features,
                     eta,
                     l2_penalty,
                     adagrad,
-                    ada_update_mag)
+                    ada_update_mag,
+                    lazy_l2,
+                    l1_penalty)
         acc = 1.0 * num_correct / len(examples)
+        if dev_examples:
+            if lazy_l2:
+                lazy_l2.catch_up_all(model.weights, adagrad)
+            dev_acc = candidates_accuracy(dev_candidates, model.weights)
+            if dev_acc > best_dev_acc:
+                best_dev_acc, best_epoch, best_weights = dev_acc, t, dict(model.weights)
         print(
             'iter. {0:}; '
             'err. {1:0.07f}; '
             'AdaGrad mag. {2:0.07f}; '
-            'train acc. {3:0.04f}'.format(t+1, error, ada_update_mag, acc))
-        if error < epsilon or ada_update_mag < epsilon:
+            'train acc. {3:0.04f}'.format(t+1, error, ada_update_mag, acc) +
+            ('; dev acc. {0:0.04f}'.format(dev_acc) if dev_examples else ''))
+        stop = error < epsilon or ada_update_mag < epsilon
+        if not stop and dev_examples and t - best_epoch >= patience:
+            print('No improvement in dev acc. for %d iters.' % patience)
+            stop = True
+        if stop:
+            if checkpoint_path:
+                # Record the stop, so that resuming does not train further.
+                save(t + 1, 0, stopped=True)
             break
+        if checkpoint_path:
+            save(t + 1, 0)
+    if lazy_l2:
+        lazy_l2.catch_up_all(model.weights, adagrad)
+    if best_weights is not None:
+        print('Restoring weights from iter. %d, with dev acc. %0.04f' % (
+            best_epoch + 1, best_dev_acc))
+        model.weights = defaultdict(float, best_weights)
+    if l1_penalty:
+        # Truncation has already removed weights from the model as it went.
+        print('Truncated gradient left %d of %d features' % (len(model.weights), len(adagrad)))
+        model.weights = prune_weights(model.weights)
     print_weights(model.weights)
     return model
 
+def resume_latent_sgd(model, examples, training_metric, checkpoint_path, dev_examples=[], dev_metric=None):
+    """
+    Continues a run of latent_sgd() from the checkpoint it saved in the given
+    file, with the same parameters, and keeps saving checkpoints there.  The
+    model and the (training and dev) examples must be constructed as for the
+    original run.
+    Because the checkpoint includes the order of the examples and the state of
+    the random number generator, the result is the same as that of an
+    uninterrupted run.
+    """
+    checkpoint = load_checkpoint(checkpoint_path, model)
+    print('Resuming from %s at iter. %d, example %d' % (
+        checkpoint_path, checkpoint['epoch'] + 1, checkpoint['position']))
+    return latent_sgd(model,
+                      examples,
+                      training_metric,
+                      checkpoint_path=checkpoint_path,
+                      checkpoint=checkpoint,
+                      dev_examples=dev_examples,
+                      dev_metric=dev_metric,
+                      **checkpoint['params'])
+
+def stable_feature(feature):
+    """
+    Returns the given feature name with any memory addresses removed.  Rule
+    features include the str() of rules, which for rules with functions as
+    semantics contain addresses that change from one process to the next.
+    """
+    if isinstance(feature, str):
+        return re.sub(r' at 0x[0-9a-fA-F]+', '', feature)
+    return feature
+
+def save_checkpoint(path, state):
+    """
+    Saves the given training state to the given file as a gzipped pickle,
+    with feature names made stable across processes.  The file is replaced
+    atomically, so that a crash while saving leaves the previous checkpoint
+    intact.
+    """
+    def stable(features):
+        return dict((stable_feature(f), v) for f, v in features.items())
+    state = dict(state)
+    state['weights'] = stable(state['weights'])
+    state['adagrad'] = stable(state['adagrad'])
+    if state['lazy_l2']:
+        num_updates, num_penalized = state['lazy_l2']
+        state['lazy_l2'] = (num_updates, stable(num_penalized))
+    best_dev_acc, best_epoch, best_weights = state['best']
+    if best_weights is not None:
+        state['best'] = (best_dev_acc, best_epoch, stable(best_weights))
+    with gzip.open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(path, model):
+    """
+    Loads a training state saved by save_checkpoint(), mapping its feature
+    names back to those of the rules in the grammar of the given model.
+    """
+    with gzip.open(path, 'rb') as f:
+        state = pickle.load(f)
+    grammar = model.grammar
+    rule_indexes = [grammar.lexical_rules, grammar.unary_rules, grammar.binary_rules]
+    current = dict((stable_feature(str(rule)), str(rule))
+                   for rule_index in rule_indexes
+                   for rules in rule_index.values()
+                   for rule in rules)
+    def restore(features):
+        return dict((current.get(f, f), v) for f, v in features.items())
+    state['weights'] = restore(state['weights'])
+    state['adagrad'] = restore(state['adagrad'])
+    if state['lazy_l2']:
+        num_updates, num_penalized = state['lazy_l2']
+        state['lazy_l2'] = (num_updates, restore(num_penalized))
+    best_dev_acc, best_epoch, best_weights = state['best']
+    if best_weights is not None:
+        state['best'] = (best_dev_acc, best_epoch, restore(best_weights))
+    return state
+
+class Candidate:
+    """
+    A candidate parse for a training example, together with its feature vector
+    and a flag saying whether it is correct according to the training metric.
+    """
+    def __init__(self, parse, features, correct):
+        self.parse = parse
+        self.features = features
+        self.correct = correct
+
+def parse_candidates(model, example, training_metric, correctness_cache=None):
+    """
+    Parses the input of the given example, executes and featurizes each parse,
+    and returns the list of Candidates in chart order.  Unlike
+    `Model.parse_input`, this does not score or sort the parses; see
+    rescore_candidates().  Correctness is looked up in the given
+    `metrics.CorrectnessCache`, if any, so that it is computed only once per
+    distinct semantics, however often the example is reparsed.
+    """
+    if correctness_cache is None:
+        correctness_cache = CorrectnessCache()
+    parses = model.grammar.parse_input(example.input)
+    model.execute_parses(parses)
+    correct = correctness_cache.correct(training_metric, example, parses)
+    return [Candidate(parse, model.feature_fn(parse), c) for parse, c in zip(parses, correct)]
+
+def score_candidates(candidates, weights):
+    """Scores the given candidates under the given weights, in place."""
+    for candidate in candidates:
+        candidate.parse.score = sum(
+            weights.get(feature, 0.0) * value for feature, value in list(candidate.features.items()))
+
+def rescore_candidates(candidates, weights):
+    """
+    Scores the given candidates under the given weights and returns them sorted
+    by descending score.  If the candidates are given in chart order, ties are
+    ordered exactly as `Model.parse_input` would order them.
+    """
+    score_candidates(candidates, weights)
+    return sorted(candidates, key=lambda candidate: candidate.parse.score, reverse=True)
+
+def top_candidates(candidates, weights, k):
+    """
+    Like rescore_candidates(), but returns only the k highest-scoring
+    candidates, found with a heap in O(n log k) time.  Ties are ordered as by
+    rescore_candidates().
+    """
+    score_candidates(candidates, weights)
+    return heapq.nlargest(k, candidates, key=lambda candidate: candidate.parse.score)
+
+def candidates_accuracy(candidates_list, weights):
+    """
+    Takes a list with the candidates for each of a set of examples, and
+    returns the fraction of examples whose highest-scoring candidate is
+    correct under the given weights.
+    """
+    num_correct = 0
+    for candidates in candidates_list:
+        candidates = rescore_candidates(candidates, weights)
+        if candidates and candidates[0].correct:
+            num_correct += 1
+    return 1.0 * num_correct / len(candidates_list)
+
 def cost(parse_1, parse_2):
     return 0.0 if parse_1 == parse_2 else 1.0
 
@@ -117,19 +427,65 @@ def clone_model(model):
     return Model(grammar=model.grammar,
                  feature_fn=model.feature_fn,
                  weights=defaultdict(float),  # Zero the weights.
-                 executor=model.executor)
+                 executor=model.executor,
+                 batch_executor=model.batch_executor)
+
+def prune_weights(weights, threshold=0.0, top_n=None):
+    """
+    Returns a copy of the given weights without the features whose weights
+    are at most threshold in absolute value, and keeping only the top_n
+    features with the largest absolute weights, if top_n is given.  Prints
+    the size of the model before and after.
+    """
+    pairs = [(f, w) for f, w in weights.items() if abs(w) > threshold]
+    if top_n is not None and len(pairs) > top_n:
+        pairs = heapq.nlargest(top_n, pairs, key=lambda pair: abs(pair[1]))
+    print('Pruned model from %d to %d features' % (len(weights), len(pairs)))
+    return defaultdict(float, pairs)
+
+def prune_model(model, threshold=0.0, top_n=None):
+    """Returns a copy of the given model, with its weights pruned by prune_weights()."""
+    return Model(grammar=model.grammar,
+                 feature_fn=model.feature_fn,
+                 weights=prune_weights(model.weights, threshold, top_n),
+                 executor=model.executor,
+                 batch_executor=model.batch_executor)
+
+def update_weights(model, target_parse, predicted_parse, eta, l2_penalty, adagrad, ada_update_mag, lazy_l2=None, l1_penalty=0.0):
+    return update_weights_with_features(
+        model,
+        model.feature_fn(target_parse),
+        model.feature_fn(predicted_parse),
+        eta,
+        l2_penalty,
+        adagrad,
+        ada_update_mag,
+        lazy_l2,
+        l1_penalty)
 
-def update_weights(model, target_parse, predicted_parse, eta, l2_penalty, adagrad, ada_update_mag):
-    target_features = model.feature_fn(target_parse)
-    predicted_features = model.feature_fn(predicted_parse)
+def update_weights_with_features(model, target_features, predicted_features, eta, l2_penalty, adagrad, ada_update_mag, lazy_l2=None, l1_penalty=0.0):
     all_f = set(target_features.keys()) | set(predicted_features.keys())
     # Gradient:
     grad = defaultdict(float)
     for f in all_f:
-        grad[f] = target_features[f] - predicted_features[f]
+        grad[f] = target_features.get(f, 0.0) - predicted_features.get(f, 0.0)
+    return apply_gradient(model, grad, eta, l2_penalty, adagrad, ada_update_mag, lazy_l2, l1_penalty)
+
+def apply_gradient(model, grad, eta, l2_penalty, adagrad, ada_update_mag, lazy_l2=None, l1_penalty=0.0):
+    """
+    Applies an AdaGrad update to the weights of the given model, for the given
+    gradient (a defaultdict from features to floats) plus the L2 penalty.
+    If lazy_l2 (a LazyL2Penalty) is given, the penalty is applied only to the
+    features in the gradient, and lazy_l2 catches up the others later.
+    If l1_penalty is nonzero, the updated weights are then truncated towards
+    zero by l1_penalty times their step size, and removed if they reach it.
+    """
     # L2 penalty:
-    for f, w in model.weights.items():
-        grad[f] -= l2_penalty * w
+    if lazy_l2:
+        lazy_l2.penalize(model.weights, adagrad, grad)
+    elif l2_penalty:
+        for f, w in model.weights.items():
+            grad[f] -= l2_penalty * w
     # Adaptive gradient update:
     for f, w in grad.items():
         adagrad[f] += grad[f]**2
@@ -138,8 +494,632 @@ def update_weights(model, target_parse, predicted_parse, eta, l2_penalty, adagra
             dw = eta * (grad[f] / ada_decay)
             model.weights[f] += dw
             ada_update_mag += dw**2
+            if l1_penalty:
+                w = model.weights[f]
+                shrinkage = eta * l1_penalty / ada_decay
+                if abs(w) <= shrinkage:
+                    del model.weights[f]
+                else:
+                    model.weights[f] = w - math.copysign(shrinkage, w)
     return (ada_update_mag, adagrad)
 
+class LazyL2Penalty:
+    """
+    Applies an L2 penalty to weights lazily.  Penalizing every weight at every
+    update costs time proportional to the size of the model, rather than to
+    the number of features active in the update.  Instead, we count updates,
+    record for each feature how many of them it has been penalized for, and
+    catch up on the missed ones only when the feature is next touched, either
+    by an update or by scoring.
+
+    For each missed update, a weight is decayed by the factor
+    (1 - eta * l2_penalty / sqrt(adagrad[f])), which is what an eager update
+    would do, except that the missed penalties are not added to the AdaGrad
+    history of the feature.
+    """
+    def __init__(self, l2_penalty, eta):
+        self.l2_penalty = l2_penalty
+        self.eta = eta
+        self.num_updates = 0
+        self.num_penalized = defaultdict(int)  # feature => number of updates
+
+    def catch_up(self, weights, adagrad, features):
+        """Applies all missed penalties to the weights of the given features."""
+        for f in features:
+            missed = self.num_updates - self.num_penalized[f]
+            if missed and weights.get(f) and adagrad[f]:
+                decay = max(0.0, 1.0 - self.eta * self.l2_penalty / math.sqrt(adagrad[f]))
+                weights[f] *= decay ** missed
+            self.num_penalized[f] = self.num_updates
+
+    def catch_up_all(self, weights, adagrad):
+        self.catch_up(weights, adagrad, list(weights.keys()))
+
+    def penalize(self, weights, adagrad, grad):
+        """
+        Adds the L2 penalty for the current update to the given gradient, for
+        just the features it contains, and counts the update.
+        """
+        self.catch_up(weights, adagrad, grad.keys())
+        for f in list(grad.keys()):
+            grad[f] -= self.l2_penalty * weights.get(f, 0.0)
+            self.num_penalized[f] += 1
+        self.num_updates += 1
+
+
+# perceptron ===================================================================
+
+def latent_perceptron(
+        model,
+        examples,
+        training_metric,
+        T=10,
+        seed=None,
+        averaged=True,
+        reparse_every=None):
+    """
+    Trains a latent structured perceptron.  For each example, if the
+    highest-scoring candidate is not correct under the training metric, the
+    weights are moved towards the features of the highest-scoring correct
+    candidate and away from those of the predicted one.  Unlike latent_sgd(),
+    there is no learning rate and no AdaGrad state, and learning stops as
+    soon as an epoch makes no mistakes.
+
+    If averaged is true, returns the average of the weights over all steps,
+    which generalizes much better.  Averaging uses the trick of Daume (2006):
+    alongside the weights w, we accumulate u, the sum of the updates each
+    multiplied by the step at which it was made, so that the average is just
+    w - u / c after c steps.  Each update therefore costs time proportional
+    to the number of active features, rather than to the size of the model.
+
+    Parameters
+    ----------
+    model, examples, training_metric, T, seed, reparse_every
+        As for latent_sgd().
+    averaged : bool
+        Whether to return averaged weights.
+
+    Returns
+    -------
+    Trained `scoring.Model` instance.
+    """
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running %sperceptron learning on %d examples with training metric: %s\n' % (
+        'averaged ' if averaged else '', len(examples), training_metric.name()))
+    if seed:
+        print('random.seed(%d)' % seed)
+        random.seed(seed)
+    model = clone_model(model)
+    weighted_updates = defaultdict(float)  # u, in the docstring
+    c = 1
+    candidates_cache = {}
+    correctness_cache = CorrectnessCache()
+    for t in range(T):
+        random.shuffle(examples)
+        reparse = reparse_every and t % reparse_every == 0
+        num_correct = 0
+        num_mistakes = 0
+        for example in examples:
+            if reparse or example not in candidates_cache:
+                candidates_cache[example] = parse_candidates(
+                    model, example, training_metric, correctness_cache)
+            candidates = rescore_candidates(candidates_cache[example], model.weights)
+            good_candidates = [cand for cand in candidates if cand.correct]
+            if good_candidates:
+                max_score = candidates[0].parse.score
+                predicted = random.choice(
+                    [cand for cand in candidates if cand.parse.score == max_score])
+                if predicted.correct:
+                    num_correct += 1
+                else:
+                    num_mistakes += 1
+                    target = good_candidates[0]
+                    for f in set(target.features) | set(predicted.features):
+                        delta = target.features.get(f, 0.0) - predicted.features.get(f, 0.0)
+                        model.weights[f] += delta
+                        weighted_updates[f] += c * delta
+            c += 1
+        acc = 1.0 * num_correct / len(examples)
+        print('iter. {0:}; mistakes {1:}; train acc. {2:0.04f}'.format(t+1, num_mistakes, acc))
+        if num_mistakes == 0:
+            break
+    if averaged:
+        for f, u in list(weighted_updates.items()):
+            model.weights[f] -= u / c
+    print_weights(model.weights)
+    return model
+
+
+# log-linear training over packed forests ======================================
+
+def loglinear_sgd(
+        model,
+        examples,
+        training_metric,
+        T=10,
+        eta=0.1,
+        seed=None,
+        l2_penalty=0.0,
+        epsilon=1e-7,
+        root_feature_fn=None):
+    """
+    Trains a log-linear (CRF-style) model, maximizing the marginal likelihood
+    of the derivations whose roots are correct under the training metric.
+    Rather than enumerating parses, each example is parsed once into a packed
+    forest (see `parsing.parse_forest`), and the expected feature counts
+    under both the full distribution and the distribution restricted to
+    correct roots are computed by inside-outside.  The gradient is their
+    difference.  This scales to inputs with far more derivations than could
+    ever be enumerated.
+
+    Inside-outside requires features which decompose over the forest.  We
+    use a rule feature for each edge, exactly as `scoring.rule_features`
+    does, plus, optionally, features of the root nodes from root_feature_fn,
+    which may depend on their semantics and denotation.  To use the learned
+    weights for parsing, the feature_fn of the model should therefore be
+    rule_features plus root_feature_fn.
+
+    Parameters
+    ----------
+    model, examples, training_metric, T, eta, seed, l2_penalty, epsilon
+        As for latent_sgd().  The error reported is the negative log
+        marginal likelihood of the correct roots.
+    root_feature_fn : function or None
+        Takes a root ForestNode and returns a map from feature names to float
+        values, like a feature_fn which only looks at semantics and
+        denotation.
+
+    Returns
+    -------
+    Trained `scoring.Model` instance.
+    """
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running log-linear SGD learning on %d examples with training metric: %s\n' % (
+        len(examples), training_metric.name()))
+    if seed:
+        print('random.seed(%d)' % seed)
+        random.seed(seed)
+    model = clone_model(model)
+    adagrad = defaultdict(float)
+    lazy_l2 = LazyL2Penalty(l2_penalty, eta) if l2_penalty else None
+    forests = {}
+    for t in range(T):
+        random.shuffle(examples)
+        num_correct = 0
+        ada_update_mag = 0.0
+        error = 0.0
+        for example in examples:
+            if example not in forests:
+                forests[example] = featurize_forest(
+                    model, example, training_metric, root_feature_fn)
+            forest = forests[example]
+            if not any(forest.correct):
+                continue
+            if lazy_l2:
+                lazy_l2.catch_up(model.weights, adagrad, forest.features)
+            log_z, expected, best_root = forest_expectations(forest, model.weights, False)
+            log_z_correct, expected_correct, _ = forest_expectations(forest, model.weights, True)
+            error += log_z - log_z_correct
+            if forest.correct[best_root]:
+                num_correct += 1
+            grad = defaultdict(float)
+            for f in set(expected) | set(expected_correct):
+                grad[f] = expected_correct.get(f, 0.0) - expected.get(f, 0.0)
+            ada_update_mag, adagrad = apply_gradient(
+                model, grad, eta, l2_penalty, adagrad, ada_update_mag, lazy_l2)
+        acc = 1.0 * num_correct / len(examples)
+        print(
+            'iter. {0:}; '
+            'err. {1:0.07f}; '
+            'AdaGrad mag. {2:0.07f}; '
+            'train acc. {3:0.04f}'.format(t+1, error, ada_update_mag, acc))
+        if error < epsilon or ada_update_mag < epsilon:
+            break
+    if lazy_l2:
+        lazy_l2.catch_up_all(model.weights, adagrad)
+    print_weights(model.weights)
+    return model
+
+class FeaturizedForest:
+    """
+    The packed forest for a training example, prepared for inside-outside.
+    Nodes are numbered so that children precede their parents, and each edge
+    is stored as a pair (feature, child node numbers).
+    """
+    def __init__(self, roots, nodes, root_features, correct):
+        node_ids = dict((id(node), i) for i, node in enumerate(nodes))
+        self.edges = [
+            [(str(rule), [node_ids[id(c)] for c in children if isinstance(c, ForestNode)])
+             for rule, children in node.edges]
+            for node in nodes]
+        self.roots = [node_ids[id(root)] for root in roots]
+        self.root_features = root_features
+        self.correct = correct
+        self.features = set(f for edges in self.edges for f, children in edges)
+        self.features.update(f for features in root_features for f in features)
+
+def featurize_forest(model, example, training_metric, root_feature_fn=None, correctness_cache=None):
+    if correctness_cache is None:
+        correctness_cache = CorrectnessCache()
+    roots = parse_forest(model.grammar, example.input)
+    model.execute_parses(roots)
+    root_features = []
+    for root in roots:
+        root_features.append(dict(root_feature_fn(root)) if root_feature_fn else {})
+    correct = correctness_cache.correct(training_metric, example, roots)
+    return FeaturizedForest(roots, forest_nodes(roots), root_features, correct)
+
+def forest_expectations(forest, weights, correct_only):
+    """
+    Runs inside-outside over the given FeaturizedForest.  Returns a triple of
+    the log partition function, the expected feature counts, and the index of
+    the root of the highest-scoring derivation.  If correct_only is true,
+    the distribution is restricted to derivations with correct roots.
+    """
+    def w(f):
+        return weights.get(f, 0.0)
+    inside = []
+    viterbi = []
+    for edges in forest.edges:
+        edge_scores = [w(f) + sum(inside[c] for c in children) for f, children in edges]
+        inside.append(logsumexp(edge_scores))
+        viterbi.append(max(w(f) + sum(viterbi[c] for c in children) for f, children in edges))
+    root_feature_scores = [sum(w(f) * v for f, v in features.items())
+                           for features in forest.root_features]
+    best_root = max(range(len(forest.roots)),
+                    key=lambda r: viterbi[forest.roots[r]] + root_feature_scores[r])
+    root_scores = []
+    for r, node in enumerate(forest.roots):
+        if correct_only and not forest.correct[r]:
+            root_scores.append(float('-inf'))
+        else:
+            root_scores.append(inside[node] + root_feature_scores[r])
+    log_z = logsumexp(root_scores)
+    expected = defaultdict(float)
+    # Outside scores, normalized by the partition function.
+    outside = [float('-inf')] * len(forest.edges)
+    for r, node in enumerate(forest.roots):
+        if root_scores[r] == float('-inf'):
+            continue
+        posterior = math.exp(root_scores[r] - log_z)
+        for f, v in forest.root_features[r].items():
+            expected[f] += posterior * v
+        outside[node] = logaddexp(outside[node], root_feature_scores[r] - log_z)
+    for node in range(len(forest.edges) - 1, -1, -1):
+        if outside[node] == float('-inf'):
+            continue
+        for f, children in forest.edges[node]:
+            edge_score = outside[node] + w(f) + sum(inside[c] for c in children)
+            expected[f] += math.exp(edge_score)
+            for c in children:
+                outside[c] = logaddexp(outside[c], edge_score - inside[c])
+    return log_z, expected, best_root
+
+def logsumexp(values):
+    max_value = max(values) if values else float('-inf')
+    if max_value == float('-inf'):
+        return max_value
+    return max_value + math.log(sum(math.exp(v - max_value) for v in values))
+
+def logaddexp(x, y):
+    return logsumexp([x, y])
+
+
+# array-backed SGD =============================================================
+
+def array_latent_sgd(
+        model,
+        examples,
+        training_metric,
+        T=10,
+        eta=0.1,
+        seed=None,
+        l2_penalty=0.0,
+        epsilon=1e-7,
+        reparse_every=None):
+    """
+    A variant of latent_sgd() which indexes features by integer ids and keeps
+    the weights and AdaGrad state in NumPy arrays.  Candidates are scored, and
+    AdaGrad updates applied, with fancy indexing over the ids of the active
+    features.  Under a fixed seed, this learns the same weights as
+    latent_sgd() (exactly, without an L2 penalty, and up to rounding error
+    with one), but it is much faster when the feature space is large.
+
+    Requires NumPy.  The parameters are as for latent_sgd().
+
+    Returns
+    -------
+    Trained `scoring.Model` instance.
+    """
+    import numpy as np
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running array-backed SGD learning on %d examples with training metric: %s\n' % (
+        len(examples), training_metric.name()))
+    if seed:
+        print('random.seed(%d)' % seed)
+        random.seed(seed)
+    model = clone_model(model)
+    # Feature id 0 is reserved for padding, and its weight is always 0.
+    feature_ids = {}
+    arrays = {
+        'weights': np.zeros(1),
+        'adagrad': np.zeros(1),
+        'num_penalized': np.zeros(1, dtype=np.int64),
+    }
+    num_updates = 0
+
+    def index_candidates(candidates):
+        # Returns a pair of 2-d arrays holding the feature ids and values of
+        # the candidates, one row per candidate, padded with id 0.
+        width = max([len(c.features) for c in candidates] + [0])
+        ids = np.zeros((len(candidates), width), dtype=np.int64)
+        values = np.zeros((len(candidates), width))
+        for row, candidate in enumerate(candidates):
+            for col, (f, value) in enumerate(list(candidate.features.items())):
+                if f not in feature_ids:
+                    feature_ids[f] = len(feature_ids) + 1
+                ids[row, col] = feature_ids[f]
+                values[row, col] = value
+        # Grow the arrays to cover any new features.
+        growth = len(feature_ids) + 1 - len(arrays['weights'])
+        if growth > 0:
+            for name, array in list(arrays.items()):
+                arrays[name] = np.concatenate([array, np.zeros(growth, dtype=array.dtype)])
+        return ids, values
+
+    def catch_up(ids):
+        # Applies missed L2 penalties, as LazyL2Penalty.catch_up() does.
+        weights, adagrad = arrays['weights'], arrays['adagrad']
+        missed = num_updates - arrays['num_penalized'][ids]
+        mask = (missed > 0) & (weights[ids] != 0.0) & (adagrad[ids] != 0.0)
+        if mask.any():
+            decay = np.maximum(0.0, 1.0 - eta * l2_penalty / np.sqrt(adagrad[ids[mask]]))
+            weights[ids[mask]] *= decay ** missed[mask]
+        arrays['num_penalized'][ids] = num_updates
+
+    cache = {}
+    correctness_cache = CorrectnessCache()
+    for t in range(T):
+        random.shuffle(examples)
+        reparse = reparse_every and t % reparse_every == 0
+        num_correct = 0
+        ada_update_mag = 0.0
+        error = 0.0
+        for example in examples:
+            if reparse or example not in cache:
+                candidates = parse_candidates(model, example, training_metric, correctness_cache)
+                ids, values = index_candidates(candidates)
+                correct = [c.correct for c in candidates]
+                cache[example] = (ids, values, correct)
+            ids, values, correct = cache[example]
+            weights, adagrad = arrays['weights'], arrays['adagrad']
+            if l2_penalty:
+                catch_up(np.unique(ids))
+            # Accumulate each row left to right, just as sum() would, so that
+            # scores (and therefore ties) are identical to latent_sgd().
+            if ids.shape[1]:
+                scores = np.cumsum(weights[ids] * values, axis=1)[:, -1]
+            else:
+                scores = np.zeros(len(correct))
+            order = np.argsort(-scores, kind='stable')
+            good = [i for i in order if correct[i]]
+            if good:
+                target = good[0]
+                augmented = scores + 1.0
+                augmented[target] -= 1.0
+                max_score = augmented.max()
+                error += float(max_score - scores[target])
+                predicted = random.choice([i for i in order if augmented[i] == max_score])
+                if correct[order[0]]:
+                    num_correct += 1
+                # Gradient over the union of active features:
+                active_ids = np.concatenate([ids[target], ids[predicted]])
+                active_values = np.concatenate([values[target], -values[predicted]])
+                keep = active_ids != 0
+                grad_ids, inverse = np.unique(active_ids[keep], return_inverse=True)
+                grad = np.zeros(len(grad_ids))
+                np.add.at(grad, inverse, active_values[keep])
+                # L2 penalty:
+                if l2_penalty:
+                    catch_up(grad_ids)
+                    grad -= l2_penalty * weights[grad_ids]
+                    arrays['num_penalized'][grad_ids] += 1
+                    num_updates += 1
+                # Adaptive gradient update:
+                adagrad[grad_ids] += grad**2
+                ada_decay = np.sqrt(adagrad[grad_ids])
+                nonzero = ada_decay != 0.0
+                dw = eta * (grad[nonzero] / ada_decay[nonzero])
+                weights[grad_ids[nonzero]] += dw
+                ada_update_mag += float(np.sum(dw**2))
+        acc = 1.0 * num_correct / len(examples)
+        print(
+            'iter. {0:}; '
+            'err. {1:0.07f}; '
+            'AdaGrad mag. {2:0.07f}; '
+            'train acc. {3:0.04f}'.format(t+1, error, ada_update_mag, acc))
+        if error < epsilon or ada_update_mag < epsilon:
+            break
+    if l2_penalty:
+        catch_up(np.arange(1, len(arrays['weights'])))
+    for f, i in list(feature_ids.items()):
+        model.weights[f] = float(arrays['weights'][i])
+    print_weights(model.weights)
+    return model
+
+
+# parallel mini-batch SGD ======================================================
+
+# State shared with the worker processes of parallel_latent_sgd().  It is set
+# before the workers are forked, so that they inherit the model and examples
+# rather than receiving them by pickling, which would fail for grammars whose
+# rules have lambdas as semantics.
+_parallel_state = {}
+
+def parallel_latent_sgd(
+        model,
+        examples,
+        training_metric,
+        T=10,
+        eta=0.1,
+        seed=None,
+        batch_size=32,
+        processes=None,
+        l2_penalty=0.0,
+        epsilon=1e-7):
+    """
+    A parallel variant of latent_sgd().  Each example is parsed and featurized
+    once, in a pool of worker processes.  Each epoch is then split into
+    mini-batches, and the hinge-loss gradients of the examples in each
+    mini-batch are computed in the pool and summed into a single AdaGrad
+    update.  With batch_size=1, this is essentially latent_sgd().
+
+    Worker processes are forked, so this requires a platform which supports
+    the 'fork' start method.
+
+    Parameters
+    ----------
+    model, examples, training_metric, T, eta, l2_penalty, epsilon
+        As for latent_sgd().
+    seed : int or None
+        Use to fix the randomization in how examples are shuffled and ties are
+        decided.  Given a seed, the result does not depend on the number of
+        processes.
+    batch_size : int
+        Number of examples per AdaGrad update.
+    processes : int or None
+        Number of worker processes.  If None, use one per CPU.  If 1, do
+        all the work in this process.
+
+    Returns
+    -------
+    Trained `scoring.Model` instance.
+    """
+    import multiprocessing
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running parallel SGD learning on %d examples with training metric: %s\n' % (
+        len(examples), training_metric.name()))
+    processes = processes or multiprocessing.cpu_count()
+    rng = random.Random(seed)
+    model = clone_model(model)
+    _parallel_state['model'] = model
+    _parallel_state['examples'] = examples
+    _parallel_state['training_metric'] = training_metric
+    indices = list(range(len(examples)))
+    # The pools are created only after _parallel_state is populated, so that
+    # the forked workers inherit it.
+    def make_pool():
+        if processes == 1:
+            return None
+        return multiprocessing.get_context('fork').Pool(processes)
+    def close_pool(pool):
+        if pool:
+            pool.close()
+            pool.join()
+    def map_chunks(pool, fn, args):
+        # Splits args into one chunk per worker, and returns the results of
+        # applying fn to each chunk, flattened back into the order of args.
+        if not pool:
+            return fn(args)
+        results = pool.map(fn, [args[i::processes] for i in range(processes)])
+        ordered = [None] * len(args)
+        for i, chunk_results in enumerate(results):
+            ordered[i::processes] = chunk_results
+        return ordered
+    pool = make_pool()
+    try:
+        _parallel_state['candidates'] = map_chunks(pool, _featurize_examples, indices)
+    finally:
+        close_pool(pool)
+    pool = make_pool()
+    try:
+        adagrad = defaultdict(float)
+        for t in range(T):
+            rng.shuffle(indices)
+            num_correct = 0
+            ada_update_mag = 0.0
+            error = 0.0
+            for start in range(0, len(indices), batch_size):
+                weights = dict(model.weights)
+                batch = [(index, rng.getrandbits(32), weights)
+                         for index in indices[start:start + batch_size]]
+                grad = defaultdict(float)
+                for example_grad, example_error, correct in map_chunks(pool, _hinge_gradients, batch):
+                    if example_grad is None:
+                        continue
+                    for f, value in example_grad.items():
+                        grad[f] += value
+                    error += example_error
+                    if correct:
+                        num_correct += 1
+                ada_update_mag, adagrad = apply_gradient(
+                    model, grad, eta, l2_penalty, adagrad, ada_update_mag)
+            acc = 1.0 * num_correct / len(examples)
+            print(
+                'iter. {0:}; '
+                'err. {1:0.07f}; '
+                'AdaGrad mag. {2:0.07f}; '
+                'train acc. {3:0.04f}'.format(t+1, error, ada_update_mag, acc))
+            if error < epsilon or ada_update_mag < epsilon:
+                break
+    finally:
+        close_pool(pool)
+        _parallel_state.clear()
+    print_weights(model.weights)
+    return model
+
+def _featurize_examples(indices):
+    """
+    Worker function for parallel_latent_sgd().  Returns, for each of the given
+    example indices, a list of (features, correct) pairs, one per candidate.
+    Parses themselves are not returned, because they cannot be pickled.
+    """
+    model = _parallel_state['model']
+    examples = _parallel_state['examples']
+    training_metric = _parallel_state['training_metric']
+    return [[(dict(c.features), c.correct)
+             for c in parse_candidates(model, examples[index], training_metric)]
+            for index in indices]
+
+def _hinge_gradients(batch):
+    """
+    Worker function for parallel_latent_sgd().  Takes a list of (example index,
+    tie-breaking seed, weights) triples, and returns for each a triple
+    (gradient, error, correct) for the hinge loss of that example.  If the
+    example has no correct candidate, the gradient and error are None.
+    """
+    results = []
+    for index, tie_seed, weights in batch:
+        candidates = _parallel_state['candidates'][index]
+        scores = [sum(weights.get(f, 0.0) * v for f, v in features.items())
+                  for features, correct in candidates]
+        # Sort by descending score, keeping chart order among ties, as in
+        # rescore_candidates().
+        order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)
+        good = [i for i in order if candidates[i][1]]
+        if not good:
+            results.append((None, None, False))
+            continue
+        target = good[0]
+        augmented = [(scores[i] + (0.0 if i == target else 1.0), i) for i in order]
+        max_score = max(s for s, i in augmented)
+        predicted = random.Random(tie_seed).choice([i for s, i in augmented if s == max_score])
+        target_features = candidates[target][0]
+        predicted_features = candidates[predicted][0]
+        grad = {}
+        for f in set(target_features) | set(predicted_features):
+            grad[f] = target_features.get(f, 0.0) - predicted_features.get(f, 0.0)
+        correct = candidates[order[0]][1]
+        results.append((grad, max_score - scores[target], correct))
+    return results
 
 def print_weights(weights, n=20):
     pairs = [(value, str(key)) for key, value in list(weights.items()) if value != 0]
@@ -6,6 +6,8 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+from parsing import semantics_key
+
 # An evaluation metric is a function that takes a list of parses and an example,
 # and returns a number.
 class Metric:
@@ -13,18 +15,30 @@ class Metric:
         return ''
     def evaluate(self, example, parses):
         return 0.0
+    def correctness_key(self, parse):
+        """
+        Returns a hashable key such that, for any example, parses with equal
+        keys get the same value from evaluate(example, [parse]), or None if
+        the metric offers no such key.  See CorrectnessCache.
+        """
+        return None
 
 class SemanticsAccuracyMetric(Metric):
     def name(self):
         return 'semantics accuracy'
     def evaluate(self, example, parses):
         return 1.0 if parses and parses[0].semantics == example.semantics else 0.0
+    def correctness_key(self, parse):
+        return ('semantics', semantics_key(parse.semantics))
 
 class DenotationAccuracyMetric(Metric):
     def name(self):
         return 'denotation accuracy'
     def evaluate(self, example, parses):
         return 1.0 if parses and parses[0].denotation == example.denotation else 0.0
+    def correctness_key(self, parse):
+        # Denotations are determined by semantics, and are often much larger.
+        return ('denotation', semantics_key(parse.semantics))
 
 class SemanticsOracleAccuracyMetric(Metric):
     def name(self):
@@ -34,6 +48,8 @@ class SemanticsOracleAccuracyMetric(Metric):
             if parse.semantics == example.semantics:
                 return 1.0
         return 0.0
+    def correctness_key(self, parse):
+        return ('semantics', semantics_key(parse.semantics))
 
 class DenotationOracleAccuracyMetric(Metric):
     def name(self):
@@ -43,6 +59,9 @@ class DenotationOracleAccuracyMetric(Metric):
             if parse.denotation == example.denotation:
                 return 1.0
         return 0.0
+    def correctness_key(self, parse):
+        # Denotations are determined by semantics, and are often much larger.
+        return ('denotation', semantics_key(parse.semantics))
 
 class NumParsesMetric(Metric):
     def name(self):
@@ -77,42 +96,84 @@ class SpuriousAmbiguityMetric(Metric):
     Returns 0.0 if each parse has unique semantics.
     Returns 1.0 if there are multiple parses, all sharing the same semantics.
     In general, returns a value which can be interpreted as the fraction of
-    parses whose semantics were already produced by another parse.
+    parses whose semantics were already produced by another parse.  If a
+    canonicalize function is given, parses whose semantics are equivalent
+    (see parsing.semantics_key()) count as sharing semantics.
     """
+    def __init__(self, canonicalize=None):
+        self.canonicalize = canonicalize
     def name(self):
         return 'spurious ambiguity'
     def evaluate(self, example, parses):
         if len(parses) == 1:
             return 0.0
-        sems = set([str(parse.semantics) for parse in parses])
+        if self.canonicalize:
+            sems = set([semantics_key(parse.semantics, self.canonicalize) for parse in parses])
+        else:
+            sems = set([str(parse.semantics) for parse in parses])
         # This conditional should be redundant with the final line.
         # But without it, we can return -0.0, which looks weird.
         if len(sems) == len(parses):
             return 0.0
         return 1.0 * (len(parses) - len(sems)) / (len(parses) - 1)
 
-def standard_metrics():
+class CorrectnessCache:
+    """
+    Memoizes the correctness of single parses for examples, as judged by
+    metric.evaluate(example, [parse]).  Parses are identified by the
+    correctness keys of metrics, so that the metric is evaluated only once for
+    all the parses of an example which share semantics, and metrics which
+    judge single parses alike (such as semantics accuracy and semantics oracle
+    accuracy) share their entries.  Metrics without correctness keys are
+    always evaluated.
+    """
+    def __init__(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def correct(self, metric, example, parses):
+        """
+        Returns a list of the values of metric.evaluate(example, [parse])
+        for the given parses.
+        """
+        example_cache = self.cache.setdefault(example, {})
+        values = []
+        for parse in parses:
+            key = metric.correctness_key(parse)
+            if key is None:
+                values.append(metric.evaluate(example, [parse]))
+            elif key in example_cache:
+                self.hits += 1
+                values.append(example_cache[key])
+            else:
+                self.misses += 1
+                value = example_cache[key] = metric.evaluate(example, [parse])
+                values.append(value)
+        return values
+
+def standard_metrics(canonicalize=None):
     return [
         SemanticsAccuracyMetric(),
         SemanticsOracleAccuracyMetric(),
         DenotationAccuracyMetric(),
         DenotationOracleAccuracyMetric(),
         NumParsesMetric(),
-        SpuriousAmbiguityMetric(),
+        SpuriousAmbiguityMetric(canonicalize),
     ]
 
-def semantics_match_metrics():
+def semantics_match_metrics(canonicalize=None):
     return [
         SemanticsAccuracyMetric(),
         SemanticsOracleAccuracyMetric(),
         NumParsesMetric(),
-        SpuriousAmbiguityMetric(),
+        SpuriousAmbiguityMetric(canonicalize),
     ]
 
-def denotation_match_metrics():
+def denotation_match_metrics(canonicalize=None):
     return [
         DenotationAccuracyMetric(),
         DenotationOracleAccuracyMetric(),
         NumParsesMetric(),
-        SpuriousAmbiguityMetric(),
+        SpuriousAmbiguityMetric(canonicalize),
     ]
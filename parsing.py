@@ -166,13 +166,16 @@ def parse_to_pretty_string(parse, indent=0, show_sem=False):
 # Grammar ======================================================================
 
 class Grammar:
-    def __init__(self, rules=[], annotators=[], start_symbol='$ROOT'):
+    def __init__(self, rules=[], annotators=[], start_symbol='$ROOT', canonicalize=None):
         self.categories = set()
         self.lexical_rules = defaultdict(list)
         self.unary_rules = defaultdict(list)
         self.binary_rules = defaultdict(list)
         self.annotators = annotators
         self.start_symbol = start_symbol
+        # Optionally, a function mapping semantics to canonical forms, so that
+        # parse_forest() merges items with equivalent semantics.
+        self.canonicalize = canonicalize
         for rule in rules:
             add_rule(self, rule)
         print('Created grammar with %d rules' % len(rules))
@@ -341,6 +344,125 @@ def check_capacity(chart, i, j):
         return False
     return True
 
+# Packed forests ===============================================================
+
+class ForestNode:
+    """
+    A node in a packed parse forest.  It stands for all of the parses which
+    share a span, a category, and semantics, and it records the different
+    ways of building them as a list of edges, each a pair of a Rule and a
+    tuple of children (ForestNodes, or tokens, for lexical rules).
+
+    Like Parse, a ForestNode has semantics and denotation attributes, so that
+    metrics and feature functions which consider only those can be applied
+    to it directly.
+    """
+    def __init__(self, lhs, span, semantics):
+        self.lhs = lhs
+        self.span = span
+        self.semantics = semantics
+        self.denotation = None
+        self.edges = []
+
+    def __str__(self):
+        return '(%s %s %s)' % (self.lhs, self.span, self.semantics)
+
+def semantics_key(semantics, canonicalize=None):
+    """
+    Returns a hashable key for the given semantics, which need not itself be
+    hashable (the TravelDomain, for example, uses dicts).  If a canonicalize
+    function is given (such as a graph_kb.QueryCanonicalizer), equivalent
+    semantics get the same key.
+    """
+    try:
+        hash(semantics)
+    except TypeError:
+        return repr(semantics)
+    return canonicalize(semantics) if canonicalize else semantics
+
+def parse_forest(grammar, input):
+    """
+    Like parse_input(), but instead of a list of parses, returns the list of
+    root ForestNodes of a packed forest which represents them.  The size of
+    the forest is bounded by the number of distinct (span, category,
+    semantics) triples, rather than by the number of parses, which can be
+    exponentially larger.  If the grammar has a canonicalize function,
+    semantics are compared in canonical form, and each node keeps the
+    semantics of its first edge.
+    """
+    tokens = input.split()
+    chart = defaultdict(list)
+    nodes = {}
+    canonicalize = getattr(grammar, 'canonicalize', None)
+    def add_edge(i, j, rule, children):
+        if is_lexical(rule):
+            semantics = rule.sem
+        else:
+            semantics = apply_semantics(rule, [child.semantics for child in children])
+        key = (i, j, rule.lhs, semantics_key(semantics, canonicalize))
+        node = nodes.get(key)
+        if node is None:
+            if not check_capacity(chart, i, j):
+                return
+            node = nodes[key] = ForestNode(rule.lhs, (i, j), semantics)
+            chart[(i, j)].append(node)
+        elif is_unary(rule) and node_derives(children[0], node):
+            # The new edge would close a unary cycle.
+            return
+        node.edges.append((rule, tuple(children)))
+    for j in range(1, len(tokens) + 1):
+        for i in range(j - 1, -1, -1):
+            span_tokens = tuple(tokens[i:j])
+            if hasattr(grammar, 'annotators'):
+                for annotator in grammar.annotators:
+                    for category, semantics in annotator.annotate(tokens[i:j]):
+                        add_edge(i, j, Rule(category, span_tokens, semantics), span_tokens)
+            for rule in grammar.lexical_rules[span_tokens]:
+                add_edge(i, j, rule, span_tokens)
+            for k in range(i + 1, j):
+                for node_1, node_2 in product(chart[(i, k)], chart[(k, j)]):
+                    for rule in grammar.binary_rules[(node_1.lhs, node_2.lhs)]:
+                        add_edge(i, j, rule, (node_1, node_2))
+            # As in apply_unary_rules(), we get unary closure by iterating
+            # over a list which grows as we go.
+            for node in chart[(i, j)]:
+                for rule in grammar.unary_rules[(node.lhs,)]:
+                    add_edge(i, j, rule, (node,))
+    roots = chart[(0, len(tokens))]
+    if grammar.start_symbol:
+        roots = [root for root in roots if root.lhs == grammar.start_symbol]
+    return roots
+
+def node_derives(node, target):
+    """
+    Returns true iff the given ForestNode is, or is built by unary edges
+    from, the target node.
+    """
+    if node is target:
+        return True
+    return any(is_unary(rule) and node_derives(children[0], target)
+               for rule, children in node.edges)
+
+def forest_nodes(roots):
+    """
+    Returns all the ForestNodes reachable from the given roots, ordered so
+    that each node comes after all of its children.
+    """
+    ordered = []
+    visited = set()
+    def visit(node):
+        if id(node) in visited:
+            return
+        visited.add(id(node))
+        for rule, children in node.edges:
+            for child in children:
+                if isinstance(child, ForestNode):
+                    visit(child)
+        ordered.append(node)
+    for root in roots:
+        visit(root)
+    return ordered
+
 def print_grammar(grammar):
     def all_rules(rule_index):
         return [rule for rules in list(rule_index.values()) for rule in rules]
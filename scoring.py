@@ -29,25 +29,43 @@ def rule_features(parse):
 def score(parse=None, feature_fn=None, weights=None):
     """Returns the inner product of feature_fn(parse) and weights."""
     assert parse and feature_fn and weights != None
-    return sum(weights[feature] * value for feature, value in list(feature_fn(parse).items()))
+    # Use get(), so that scoring does not grow a (pruned) defaultdict of weights.
+    return sum(weights.get(feature, 0.0) * value for feature, value in list(feature_fn(parse).items()))
 
 class Model:
     def __init__(self,
                  grammar=None,
                  feature_fn=lambda parse: defaultdict(float),
                  weights=defaultdict(float),
-                 executor=None):
+                 executor=None,
+                 batch_executor=None):
         assert grammar
         self.grammar = grammar
         self.feature_fn = feature_fn
         self.weights = weights
         self.executor = executor
+        # Optionally, a function from a list of semantics to the list of their
+        # denotations, which can share work between the parses of an input.
+        self.batch_executor = batch_executor
 
     # TODO: Should this become a static function, to match style of parsing.py?
     def parse_input(self, input):
         parses = self.grammar.parse_input(input)
+        self.execute_parses(parses)
         for parse in parses:
-            if self.executor:
-                parse.denotation = self.executor(parse.semantics)
             parse.score = score(parse, self.feature_fn, self.weights)
         return sorted(parses, key=lambda parse: parse.score, reverse=True)
+
+    def execute_parses(self, parses):
+        """
+        Sets the denotations of the given parses, with a single call to the
+        batch executor, if there is one, or else one call to the executor per
+        parse.
+        """
+        if self.batch_executor:
+            denotations = self.batch_executor([parse.semantics for parse in parses])
+            for parse, denotation in zip(parses, denotations):
+                parse.denotation = denotation
+        elif self.executor:
+            for parse in parses:
+                parse.denotation = self.executor(parse.semantics)